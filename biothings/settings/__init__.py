@@ -53,6 +53,10 @@ class BiothingSettings(object):
     def status_check_id(self):
         return self._return_var('STATUS_CHECK_ID')
 
+    @property
+    def health_check_interval(self):
+        return self._return_var('HEALTH_CHECK_INTERVAL')
+
     @property
     def field_notes_path(self):
         return self._return_var('FIELD_NOTES_PATH')
@@ -61,6 +65,46 @@ class BiothingSettings(object):
     def jsonld_context_path(self):
         return self._return_var('JSONLD_CONTEXT_PATH')
 
+    @property
+    def jsonld_context_by_reference(self):
+        return self._return_var('JSONLD_CONTEXT_BY_REFERENCE')
+
+    @property
+    def sort_keys(self):
+        return self._return_var('SORT_KEYS')
+
+    @property
+    def json_encoder(self):
+        return self._return_var('JSON_ENCODER')
+
+    @property
+    def compression_encodings(self):
+        return self._return_var('COMPRESSION_ENCODINGS')
+
+    @property
+    def compression_min_size(self):
+        return self._return_var('COMPRESSION_MIN_SIZE')
+
+    @property
+    def gzip_compression_level(self):
+        return self._return_var('GZIP_COMPRESSION_LEVEL')
+
+    @property
+    def zstd_compression_level(self):
+        return self._return_var('ZSTD_COMPRESSION_LEVEL')
+
+    @property
+    def compression_cache_max_entries(self):
+        return self._return_var('COMPRESSION_CACHE_MAX_ENTRIES')
+
+    @property
+    def compression_cache_max_bytes(self):
+        return self._return_var('COMPRESSION_CACHE_MAX_BYTES')
+
+    @property
+    def etag_version(self):
+        return self._return_var('ETAG_VERSION')
+
     @property
     def nosetest_settings(self):
         return self._return_var('NOSETEST_SETTINGS')
@@ -74,6 +118,30 @@ class BiothingSettings(object):
         return self._return_var('ES_QUERY_MODULE')
 
 
+    @property
+    def es_async(self):
+        return self._return_var('ES_ASYNC')
+
+    @property
+    def es_max_clients(self):
+        return self._return_var('ES_MAX_CLIENTS')
+
+    @property
+    def es_coalesce_requests(self):
+        return self._return_var('ES_COALESCE_REQUESTS')
+
+    @property
+    def es_get_batch_window(self):
+        return self._return_var('ES_GET_BATCH_WINDOW')
+
+    @property
+    def es_get_batch_size(self):
+        return self._return_var('ES_GET_BATCH_SIZE')
+
+    @property
+    def es_raw_passthrough(self):
+        return self._return_var('ES_RAW_PASSTHROUGH')
+
     @property
     def es_host(self):
         return self._return_var('ES_HOST')
@@ -98,9 +166,49 @@ class BiothingSettings(object):
     def scroll_size(self):
         return self._return_var('ES_SCROLL_SIZE')
 
+    @property
+    def es_max_scrolls(self):
+        return self._return_var('ES_MAX_SCROLLS')
+
+    @property
+    def es_max_client_scrolls(self):
+        return self._return_var('ES_MAX_CLIENT_SCROLLS')
+
+    @property
+    def es_scroll_idle_timeout(self):
+        return self._return_var('ES_SCROLL_IDLE_TIMEOUT')
+
     @property
     def size_cap(self):
         return self._return_var('ES_SIZE_CAP')
+
+    @property
+    def batch_terms_query(self):
+        return self._return_var('BATCH_TERMS_QUERY')
+
+    @property
+    def batch_terms_query_chunk_size(self):
+        return self._return_var('BATCH_TERMS_QUERY_CHUNK_SIZE')
+
+    @property
+    def ndjson_chunk_size(self):
+        return self._return_var('NDJSON_CHUNK_SIZE')
+
+    @property
+    def query_cache_max_entries(self):
+        return self._return_var('QUERY_CACHE_MAX_ENTRIES')
+
+    @property
+    def query_cache_max_bytes(self):
+        return self._return_var('QUERY_CACHE_MAX_BYTES')
+
+    @property
+    def query_cache_ttl(self):
+        return self._return_var('QUERY_CACHE_TTL')
+
+    @property
+    def index_metadata_refresh_interval(self):
+        return self._return_var('INDEX_METADATA_REFRESH_INTERVAL')
     
     # *************************************************************************
     # * neo4j settings wrappers
@@ -157,6 +265,22 @@ class BiothingSettings(object):
     def ga_tracker_url(self):
         return self._return_var('GA_TRACKER_URL')
 
+    @property
+    def ga_queue_size(self):
+        return self._return_var('GA_QUEUE_SIZE')
+
+    @property
+    def ga_batch_size(self):
+        return self._return_var('GA_BATCH_SIZE')
+
+    @property
+    def ga_flush_interval(self):
+        return self._return_var('GA_FLUSH_INTERVAL')
+
+    @property
+    def ga_max_clients(self):
+        return self._return_var('GA_MAX_CLIENTS')
+
     # This function returns the object that is sent to google analytics for an API call
     def ga_event_object(self, endpoint, action, data):
         ret = {}
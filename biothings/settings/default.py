@@ -11,8 +11,46 @@ ES_DOC_TYPE = 'biothing'
 ALLOWED_OPTIONS = ['_source', 'start', 'from_', 'size', 'sort', 'explain', 'version', 'aggs', 'fetch_all', 'fields']
 ES_SCROLL_TIME = '1m'
 ES_SCROLL_SIZE = 1000
+# Max number of fetch_all scrolls open at once, in total and per client IP (0 for no limit)
+ES_MAX_SCROLLS = 500
+ES_MAX_CLIENT_SCROLLS = 10
+# seconds before an idle fetch_all scroll is cleared
+ES_SCROLL_IDLE_TIMEOUT = 60
 ES_SIZE_CAP = 1000
 ES_QUERY_MODULE = 'biothings.www.api.es'
+# For POST queries on exact match (not_analyzed or numeric) scopes, send the terms in
+# batched terms queries instead of one match query per term.  Set to False if your
+# ESQueryBuilder.build_id_query adds filters or scoring the terms query would miss.
+BATCH_TERMS_QUERY = True
+# Max number of terms per terms query
+BATCH_TERMS_QUERY_CHUNK_SIZE = 500
+# Number of query terms per ES request when streaming POST results (format=ndjson)
+NDJSON_CHUNK_SIZE = 100
+# In-process cache of /query results, keyed on the query and its options.
+# Set QUERY_CACHE_MAX_ENTRIES to 0 to disable it.
+QUERY_CACHE_MAX_ENTRIES = 1000
+QUERY_CACHE_MAX_BYTES = 100 * 1024 * 1024
+# seconds before a cached result expires
+QUERY_CACHE_TTL = 600
+# Index settings, mapping and _meta are cached, and refreshed in the background
+# every INDEX_METADATA_REFRESH_INTERVAL seconds.  When the index build (or the index
+# behind the alias) changes, the query cache is cleared.
+INDEX_METADATA_REFRESH_INTERVAL = 60
+# Set to True to use the AsyncESQuery class of ES_QUERY_MODULE, querying ES without
+# blocking the IOLoop
+ES_ASYNC = False
+# Max number of concurrent requests to ES when ES_ASYNC is True
+ES_MAX_CLIENTS = 100
+# When ES_ASYNC is True, concurrent identical get_biothing and query calls share
+# a single ES request and its result
+ES_COALESCE_REQUESTS = True
+# When ES_ASYNC is True, merge the single doc GETs arriving within ES_GET_BATCH_WINDOW
+# milliseconds (or ES_GET_BATCH_SIZE ids) into one multi-get.  0 disables batching.
+ES_GET_BATCH_WINDOW = 0
+ES_GET_BATCH_SIZE = 100
+# With raw=1, pass the ES response of single doc GETs and queries through as is,
+# without decoding and encoding it again
+ES_RAW_PASSTHROUGH = True
 
 # Graph defaults
 # By default turn graph app off
@@ -45,6 +83,12 @@ GA_EVENT_GET_ACTION = 'get'
 GA_EVENT_POST_ACTION = 'post'
 # url for google analytics tracker
 GA_TRACKER_URL = 'mybiothing.info'
+# Tracking hits are queued (up to GA_QUEUE_SIZE, then dropped) and sent in batches of
+# GA_BATCH_SIZE every GA_FLUSH_INTERVAL seconds, over at most GA_MAX_CLIENTS connections
+GA_QUEUE_SIZE = 10000
+GA_BATCH_SIZE = 100
+GA_FLUSH_INTERVAL = 1
+GA_MAX_CLIENTS = 10
 
 # *****************************************************************************
 # URL settings
@@ -56,9 +100,32 @@ GRAPH_QUERY_ENDPOINT = 'graph_query'
 API_VERSION = 'v1'
 # TODO Fill in a status id here
 STATUS_CHECK_ID = 'status_id'
+# seconds between the background health checks answering /status (STATUS_CHECK_ID
+# exists and cluster health)
+HEALTH_CHECK_INTERVAL = 10
 # Path to a file containing a json object with information about elasticsearch fields
 FIELD_NOTES_PATH = 'field_notes_path'
 # For the path to the json-ld context
 JSONLD_CONTEXT_PATH = 'context'
+# If True, jsonld=true responses give the URL of each context (served by
+# JsonLdContextHandler) instead of the context itself
+JSONLD_CONTEXT_BY_REFERENCE = False
+# Sort the keys of returned JSON objects (set to False to skip sorting entirely)
+SORT_KEYS = True
+# Compress JSON responses larger than COMPRESSION_MIN_SIZE bytes, with the first of
+# COMPRESSION_ENCODINGS accepted by the client (zstd needs the zstandard module)
+COMPRESSION_ENCODINGS = ['zstd', 'gzip']
+COMPRESSION_MIN_SIZE = 1024
+GZIP_COMPRESSION_LEVEL = 6
+ZSTD_COMPRESSION_LEVEL = 3
+# Compressed bodies of the GET responses kept, so a repeated response isn't compressed again
+COMPRESSION_CACHE_MAX_ENTRIES = 100
+COMPRESSION_CACHE_MAX_BYTES = 50 * 1024 * 1024
+# Part of the ETags of GET responses, with the biothings version and the commit of the
+# codebase: change it to invalidate the cached responses after a configuration change
+ETAG_VERSION = ''
+# JSON encoder of the responses: "orjson", "ujson", "json" (stdlib) or "auto" for the
+# fastest one installed
+JSON_ENCODER = 'auto'
 # Module that contains the nosetest config
 NOSETEST_SETTINGS = 'tests.nosetest_config'
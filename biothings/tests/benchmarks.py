@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+'''
+Micro-benchmarks of the web layer hot paths, on synthetic data (no ES needed).
+run as "python -m biothings.tests.benchmarks"
+'''
+import os
+import json
+import random
+import timeit
+from collections import OrderedDict
+
+os.environ.setdefault('BIOTHING_CONFIG', 'biothings.settings.default')
+
+from biothings.utils.common import dotdict
+from biothings.utils.cache import LRUCache
+
+
+def make_doc(i, width=10, depth=3):
+    ''' a synthetic biothing doc, with nested objects and lists of objects. '''
+    rnd = random.Random(i)
+
+    def _make(level):
+        d = {}
+        for k in range(width):
+            key = 'field_{}_{}'.format(level, rnd.randint(0, 10000))
+            if level < depth and k % 5 == 0:
+                d[key] = _make(level + 1)
+            elif level < depth and k % 7 == 0:
+                d[key] = [_make(level + 1) for j in range(3)]
+            else:
+                d[key] = rnd.choice([rnd.random(), rnd.randint(0, 1000000), 'value_{}'.format(rnd.random())])
+        return d
+    doc = _make(1)
+    doc['_id'] = str(i)
+    return doc
+
+
+def make_hits(n=1000, **kwargs):
+    return [{'_id': str(i), '_score': 1.0, '_source': make_doc(i, **kwargs)} for i in range(n)]
+
+
+def make_hits_loader(n=1000, **kwargs):
+    ''' return a function decoding a fresh copy of n hits, as returned by ES. '''
+    raw = json.dumps(make_hits(n, **kwargs))
+    return lambda: json.loads(raw)
+
+
+def make_context(doc):
+    ''' a JSON-LD context for the root and every nested object key of doc. '''
+    context = {'root': {'@context': dict([(k, 'http://example.org/' + k) for k in doc])}}
+    for (k, v) in doc.items():
+        if isinstance(v, dict):
+            context[k] = {'@context': dict([(kk, 'http://example.org/' + kk) for kk in v])}
+    return context
+
+
+def get_esq(context=None):
+    ''' an ESQuery not connected to ES, enough to post-process hits. '''
+    from biothings.www.api.es import ESQuery
+    esq = ESQuery.__new__(ESQuery)
+    esq._context = context or {}
+    esq._context_tree = esq._compile_context_tree()
+    esq._context_ref_tree = esq._compile_context_tree(by_reference=True)
+    esq._doc_plans = LRUCache(max_entries=1000)
+    return esq
+
+
+def legacy_traverse(esq, doc, context_key, options=None):
+    ''' the recursive sort + JSON-LD traversal run on every hit before the doc plans. '''
+    if isinstance(doc, list):
+        return [legacy_traverse(esq, d, context_key, options) for d in doc]
+    elif isinstance(doc, dict):
+        this_list = []
+        if context_key in esq._context and options and options.jsonld:
+            doc['@context'] = esq._context[context_key]['@context']
+        for key in sorted(doc):
+            new_key = key if context_key == 'root' else context_key + '/' + key
+            this_list.append((key, legacy_traverse(esq, doc[key], new_key, options)))
+        return OrderedDict(this_list)
+    else:
+        return doc
+
+
+def legacy_multiple_id_query(qbdr, bid_list, scopes=None):
+    ''' the msearch body built one build_id_query + json.dumps per id, before the templates. '''
+    _q = []
+    for id in bid_list:
+        _q.extend(['{}', json.dumps(qbdr.build_id_query(id, scopes))])
+    _q.append('')
+    return '\n'.join(_q)
+
+
+def bench(label, fn, number=3):
+    t = min(timeit.repeat(fn, number=1, repeat=number))
+    print('{:<70}{:>10.1f} ms'.format(label, t * 1000))
+    return t
+
+
+def bench_doc_postprocessing(n=1000):
+    ''' _get_biothingdoc with a compiled doc plan vs the legacy recursive traversal. '''
+    print('Post-processing {} hits:'.format(n))
+    load_hits = make_hits_loader(n)
+    context = make_context(make_doc(0))
+    # fresh hits for each run, post-processing modifies them
+    hits_t = bench('  (decoding the hits)', load_hits)
+    for jsonld in (False, True):
+        esq = get_esq(context)
+        options = dotdict({'jsonld': jsonld, 'dotfield': True, 'kwargs': {}})
+        legacy = bench('  legacy traverse + json (indent=2), jsonld={}'.format(jsonld),
+                       lambda: json.dumps([legacy_traverse(esq, h['_source'], 'root', options) for h in load_hits()], indent=2))
+        plan = bench('  doc plan + json (sort_keys), jsonld={}'.format(jsonld),
+                     lambda: json.dumps([esq._get_biothingdoc(h, options) for h in load_hits()], sort_keys=True))
+        print('  speedup: {:.1f}x'.format((legacy - hits_t) / (plan - hits_t)))
+
+
+def bench_msearch_body(sizes=(1000, 10000)):
+    ''' ESQueryBuilder.build_multiple_id_query with a pre-rendered template vs one json.dumps per id. '''
+    from biothings.www.api.es import ESQueryBuilder
+    for n in sizes:
+        print('msearch body for {} ids:'.format(n))
+        bid_list = ['ENSG{:011d}'.format(i) for i in range(n)]
+        for scopes in ('symbol', ['symbol', 'alias', 'ensembl.gene']):
+            qbdr = ESQueryBuilder(_source=['symbol', 'name'], size=10)
+            assert qbdr.build_multiple_id_query(bid_list, scopes) == legacy_multiple_id_query(qbdr, bid_list, scopes)
+            legacy = bench('  legacy builder, scopes={}'.format(scopes),
+                           lambda: legacy_multiple_id_query(ESQueryBuilder(_source=['symbol', 'name'], size=10), bid_list, scopes))
+            template = bench('  template builder, scopes={}'.format(scopes),
+                             lambda: ESQueryBuilder(_source=['symbol', 'name'], size=10).build_multiple_id_query(bid_list, scopes))
+            print('  speedup: {:.1f}x'.format(legacy / template))
+
+
+def bench_json_encoders(n=1000):
+    ''' the JSON encoder backends on a post-processed list of hits. '''
+    from biothings.utils.jsonenc import JSON_ENCODERS, get_json_encoder
+    print('Encoding {} post-processed hits:'.format(n))
+    esq = get_esq()
+    options = dotdict({'jsonld': False, 'dotfield': True, 'kwargs': {}})
+    hits = [esq._get_biothingdoc(h, options) for h in make_hits_loader(n)()]
+    legacy = bench('  json, indent=2 (before)', lambda: json.dumps(hits, indent=2, sort_keys=True))
+    for backend in sorted(JSON_ENCODERS):
+        encode = get_json_encoder(backend)
+        assert json.loads(encode(hits)) == hits
+        t = bench('  {}, compact'.format(backend), lambda: encode(hits))
+        bench('  {}, indent=2'.format(backend), lambda: encode(hits, indent=2))
+        print('  {} compact speedup: {:.1f}x, size: {} bytes'.format(backend, legacy / t, len(encode(hits))))
+
+
+def bench_raw_passthrough(n=1000):
+    ''' a raw=1 query response: decoded and encoded again (before) vs passed through as RawJSON. '''
+    from biothings.utils.jsonenc import RawJSON, get_json_encoder
+    print('raw response of {} hits:'.format(n))
+    body = json.dumps({'took': 1, 'hits': {'total': n, 'max_score': 1.0, 'hits': make_hits(n)}})
+    encode = get_json_encoder('json')
+    legacy = bench('  decode + encode (before)', lambda: encode(json.loads(body)).encode('utf-8'))
+    passthrough = bench('  passthrough', lambda: RawJSON(body).encode('utf-8'))
+    print('  speedup: {:.1f}x'.format(legacy / passthrough))
+
+
+def bench_tabular(n=10000):
+    ''' a flat projection of n docs as JSON vs the tabular formats. '''
+    from biothings.utils.jsonenc import get_json_encoder
+    from biothings.utils.tabular import TABLE_WRITERS
+    print('{} docs, 5 fields:'.format(n))
+    fields = ['symbol', 'name', 'taxid', 'entrezgene', 'ensembl.gene']
+    docs = [{'_id': str(i), 'symbol': 'SYM{}'.format(i), 'name': 'gene {}'.format(i), 'taxid': 9606,
+             'entrezgene': i, 'ensembl': {'gene': 'ENSG{:011d}'.format(i)}} for i in range(n)]
+    encode = get_json_encoder('json')
+    legacy = bench('  json', lambda: encode(docs).encode('utf-8'))
+    json_size = len(encode(docs))
+    for fmt in sorted(TABLE_WRITERS):
+        def write():
+            writer = TABLE_WRITERS[fmt](['_id'] + fields)
+            return writer.header() + writer.rows(docs) + writer.close()
+        t = bench('  {}'.format(fmt), write)
+        print('  {} speedup: {:.1f}x, size: {:.0%} of json'.format(fmt, legacy / t, len(write()) / json_size))
+
+
+if __name__ == '__main__':
+    bench_doc_postprocessing()
+    bench_msearch_body()
+    bench_json_encoders()
+    bench_raw_passthrough()
+    bench_tabular()
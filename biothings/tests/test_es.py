@@ -0,0 +1,529 @@
+# -*- coding: utf-8 -*-
+'''
+Nose tests of ESQuery and the ES utilities, against fake ES clients (no ES needed).
+run as "nosetests biothings.tests.test_es"
+'''
+import os
+import json
+import time
+import unittest
+from unittest import mock
+from elasticsearch import Connection, ConnectionError, Elasticsearch, NotFoundError, TransportError
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+os.environ.setdefault('BIOTHING_CONFIG', 'biothings.settings.default')
+
+from biothings.settings import BiothingSettings
+from biothings.utils.es import escape_params, perform_raw_request
+from biothings.www.api import es as es_module
+from biothings.www.api.es import ESQuery, ESQueryBuilder, GetBatcher, QueryError, ScrollRegistry, unique_ids
+
+biothing_settings = BiothingSettings()
+
+
+class FakeIndices(object):
+    def __init__(self, es):
+        self.es = es
+
+    def get(self, index):
+        self.es.calls.append(('indices.get', index))
+        return {self.es.index_name: {
+            'settings': {'index': {'number_of_shards': '1'}},
+            'mappings': {biothing_settings.es_doc_type: {
+                '_meta': {'build_version': self.es.build},
+                'properties': {'symbol': {'type': 'string', 'index': 'not_analyzed'},
+                               'entrezgene': {'type': 'integer'},
+                               'name': {'type': 'string'}}}}}}
+
+
+class FakeCluster(object):
+    def __init__(self, es):
+        self.es = es
+
+    def health(self, index):
+        return {'status': self.es.cluster_status}
+
+
+class FakeES(object):
+    '''records the calls, answers with the responses set on it.'''
+    def __init__(self):
+        self.calls = []
+        self.indices = FakeIndices(self)
+        self.cluster = FakeCluster(self)
+        self.cluster_status = 'green'
+        self.index_name = 'index_1'
+        self.build = '1'
+        self.version = '6.8.0'
+        self.docs = {}
+        self.msearch_responses = None
+
+    def info(self):
+        return {'version': {'number': self.version}}
+
+    def exists(self, id, **kwargs):
+        self.calls.append(('exists', id))
+        return id in self.docs
+
+    def get(self, id, **kwargs):
+        self.calls.append(('get', id))
+        if id not in self.docs:
+            raise NotFoundError(404, 'not found')
+        return dict(self.docs[id], _id=id, found=True)
+
+    def mget(self, body, **kwargs):
+        self.calls.append(('mget', body))
+        return {'docs': [dict(self.docs[_id], _id=_id, found=True) if _id in self.docs else {'_id': _id, 'found': False}
+                         for _id in body['ids']]}
+
+    def msearch(self, body, **kwargs):
+        self.calls.append(('msearch', body))
+        return {'responses': self.msearch_responses}
+
+
+class ESQueryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.es = FakeES()
+        with mock.patch.object(es_module, 'get_es', return_value=self.es):
+            self.esq = self.esq_class()
+
+    esq_class = ESQuery
+
+
+class UniqueIdsTests(unittest.TestCase):
+    def test_unique_ids(self):
+        bids = ['a', 'b', 'a', ['x'], ['x'], 'b']
+        unique_bids, idx = unique_ids(bids)
+        # lists can't be de-duplicated
+        self.assertEqual(unique_bids, ['a', 'b', ['x'], ['x']])
+        self.assertEqual([unique_bids[i] for i in idx], bids)
+
+
+class MgetTests(ESQueryTestCase):
+    def setUp(self):
+        super(MgetTests, self).setUp()
+        self.es.docs = {'a': {'_source': {'symbol': 'A'}, '_version': 3},
+                        'b': {'_source': {'symbol': 'B'}}}
+
+    def test_fan_out(self):
+        res = self.esq.mget_biothings(['a', 'nope', 'b', 'a'])
+        # a single multi-get of the unique ids
+        self.assertEqual([call for call in self.es.calls if call[0] == 'mget'], [('mget', {'ids': ['a', 'nope', 'b']})])
+        self.assertEqual([(r['query'], r.get('notfound', False)) for r in res],
+                         [('a', False), ('nope', True), ('b', False), ('a', False)])
+        self.assertEqual([r['_score'] for r in res if 'symbol' in r], [1.0, 1.0, 1.0])
+        self.assertEqual(res[0]['symbol'], 'A')
+
+    def test_docs_as_responses(self):
+        options = self.esq._get_cleaned_annotation_options({})
+        docs = [{'_id': 'a', '_version': 3, 'found': True, '_source': {'symbol': 'A'}},
+                {'_id': 'b', 'found': False},
+                {'_id': 'c', 'error': 'shard failure'}]
+        res = self.esq._mget_docs_as_responses(docs, options)
+        self.assertEqual(res, [{'hits': {'total': 1, 'max_score': 1.0,
+                                         'hits': [{'_id': 'a', '_score': 1.0, '_source': {'symbol': 'A'}}]}},
+                               {'hits': {'total': 0, 'max_score': None, 'hits': []}},
+                               {'error': 'shard failure'}])
+        self.assertIn('found', docs[0])
+        options = self.esq._get_cleaned_annotation_options({'version': True})
+        self.assertEqual(self.esq._mget_docs_as_responses(docs, options)[0]['hits']['hits'][0]['_version'], 3)
+
+    def test_id_query_override(self):
+        class SymbolQueryBuilder(ESQueryBuilder):
+            def build_id_query(self, bid, scopes=None):
+                return {'query': {'match': {'symbol': bid}}}
+        self.esq._get_query_builder = lambda **kwargs: SymbolQueryBuilder(**kwargs)
+        self.es.msearch_responses = [{'hits': {'total': 0, 'hits': []}}]
+        self.esq.mget_biothings(['A'])
+        self.assertEqual([call[0] for call in self.es.calls if call[0] in ('mget', 'msearch')], ['msearch'])
+        self.assertIn('"symbol": "A"', self.es.calls[-1][1])
+        # unless _id is asked for
+        self.esq.mget_biothings(['a'], scopes='_id')
+        self.assertEqual(self.es.calls[-1], ('mget', {'ids': ['a']}))
+
+
+class TermsQueryTests(ESQueryTestCase):
+    def options(self, scopes, **kwargs):
+        return self.esq._get_cleaned_annotation_options(dict(kwargs, scopes=scopes))
+
+    def res(self, *hits, **kwargs):
+        return {'hits': {'total': kwargs.get('total', len(hits)), 'hits': list(hits)}}
+
+    def hit(self, _id, **fields):
+        return {'_id': _id, '_source': {}, 'fields': dict([(k, [v]) for (k, v) in fields.items()])}
+
+    def test_use_terms_query(self):
+        self.assertTrue(self.esq._use_terms_query(self.options('symbol')))
+        self.assertTrue(self.esq._use_terms_query(self.options(['symbol', 'entrezgene'])))
+        # analyzed
+        self.assertFalse(self.esq._use_terms_query(self.options(['symbol', 'name'])))
+        self.assertFalse(self.esq._use_terms_query(self.options('_id')))
+
+        class SymbolQueryBuilder(ESQueryBuilder):
+            def build_id_query(self, bid, scopes=None):
+                return {'query': {'match': {'symbol': bid}}}
+        self.esq._get_query_builder = lambda **kwargs: SymbolQueryBuilder(**kwargs)
+        self.assertFalse(self.esq._use_terms_query(self.options('symbol')))
+
+    def test_split(self):
+        options = self.options(['entrezgene', 'symbol'])
+        chunks = [['7', '007', 'ABC', 'nope'], ['X', 'Y']]
+        res = [self.res(self.hit('1', entrezgene=7), self.hit('2', symbol='ABC')),
+               # truncated
+               self.res(self.hit('3', symbol='X'), total=3)]
+        responses, fallback = self.esq._split_terms_res(chunks, res, options)
+        self.assertEqual(fallback, ['X', 'Y'])
+        self.assertEqual([r and [h['_id'] for h in r['hits']['hits']] for r in responses],
+                         [['1'], ['1'], ['2'], [], None, None])
+        # the fields used for the mapping are removed
+        self.assertNotIn('fields', responses[0]['hits']['hits'][0])
+        self.assertIsNot(responses[0]['hits']['hits'][0], responses[1]['hits']['hits'][0])
+
+    def test_split_errors(self):
+        options = self.options('symbol', size=1)
+        chunks = [['A', 'B', 'C'], ['D']]
+        # the hit of "b" can't be mapped back to "B", "B" and "C" are queried again
+        res = [self.res(self.hit('1', symbol='A'), self.hit('2', symbol='A'), self.hit('3', symbol='b')),
+               {'error': 'shard failure'}]
+        responses, fallback = self.esq._split_terms_res(chunks, res, options)
+        self.assertEqual(fallback, ['B', 'C', 'D'])
+        # at most size hits per term
+        self.assertEqual([r and r['hits']['total'] for r in responses], [1, None, None, None])
+
+
+class CursorTests(ESQueryTestCase):
+    def set_query(self, **kwargs):
+        options = self.esq._get_cleaned_query_options(kwargs)
+        _query = {'query': {'match_all': {}}}
+        self.esq._set_cursor_query(_query, kwargs, options)
+        return _query, kwargs
+
+    def test_encode_decode(self):
+        for sort_values in [[1.5, 'abc'], [u'é', None, 3]]:
+            cursor = self.esq._encode_cursor(sort_values)
+            self.assertEqual(self.esq._decode_cursor(cursor), sort_values)
+        for cursor in ['x', self.esq._encode_cursor({'a': 1}), u'é', 'true']:
+            with self.assertRaises(QueryError):
+                self.esq._decode_cursor(cursor)
+
+    def test_first_page(self):
+        _query, kwargs = self.set_query(cursor='true', from_=10)
+        self.assertEqual(_query['sort'], [{'_score': 'desc'}, {'_uid': 'asc'}])
+        self.assertNotIn('search_after', _query)
+        self.assertNotIn('from_', kwargs)
+        self.es.version, self.esq._es_version = '7.1.0', None
+        _query, kwargs = self.set_query(cursor='1', sort='-symbol')
+        self.assertEqual(_query['sort'], [{'symbol': 'desc'}, {'_id': 'asc'}])
+
+    def test_next_page(self):
+        cursor = self.esq._encode_cursor([1.5, 'abc'])
+        _query, kwargs = self.set_query(cursor=cursor)
+        self.assertEqual(_query['search_after'], [1.5, 'abc'])
+        options = self.esq._get_cleaned_query_options({'cursor': cursor, 'size': '2'})
+        res = {'hits': {'hits': [{'sort': [2.0, 'a']}, {'sort': [1.0, 'b']}]}}
+        self.assertEqual(self.esq._decode_cursor(self.esq._get_next_cursor(res, options)), [1.0, 'b'])
+        # the last page
+        res['hits']['hits'].pop()
+        self.assertIsNone(self.esq._get_next_cursor(res, options))
+
+    def test_errors(self):
+        with self.assertRaises(QueryError):
+            self.set_query(cursor='true', fetch_all='true')
+        self.es.version, self.esq._es_version = '2.4.1', None
+        with self.assertRaises(QueryError):
+            self.set_query(cursor='true')
+
+
+class BatcherESQuery(object):
+    '''the parts of AsyncESQuery used by GetBatcher.'''
+    _index = 'index'
+    _doc_type = 'doc'
+
+    def __init__(self, docs):
+        self.docs = docs
+        self.mgets = []
+
+    def _build_mget_body(self, bid_list):
+        return {'ids': bid_list}
+
+    def _get_biothing_kwargs(self, options):
+        return options
+
+    def _cleaned_get_res(self, doc, options):
+        return dict(doc['_source'], _id=doc['_id'])
+
+    @gen.coroutine
+    def _mget(self, body, index, doc_type, **kwargs):
+        self.mgets.append((body['ids'], kwargs))
+        yield gen.moment
+        if 'fail' in body['ids']:
+            raise TransportError('N/A', 'unreachable')
+        return [{'_id': _id, 'error': 'shard failure'} if _id == 'broken' else
+                dict(_id=_id, found=True, _source=self.docs[_id]) if _id in self.docs else
+                {'_id': _id, 'found': False} for _id in body['ids']]
+
+
+class GetBatcherTests(unittest.TestCase):
+    def setUp(self):
+        self.io_loop = IOLoop()
+        self.esq = BatcherESQuery({'a': {'symbol': 'A'}, 'b': {'symbol': 'B'}})
+
+    def tearDown(self):
+        self.io_loop.close()
+
+    def test_batch(self):
+        self.io_loop.run_sync(self._test_batch)
+
+    def test_max_size(self):
+        self.io_loop.run_sync(self._test_max_size)
+
+    def test_errors(self):
+        self.io_loop.run_sync(self._test_errors)
+
+    @gen.coroutine
+    def _test_batch(self):
+        batcher = GetBatcher(self.esq, window=0.01, max_size=10)
+        futures = [batcher.get(bid, {}, 'key') for bid in ['a', 'nope', 'a', 'b']]
+        # another batch for other options
+        other = batcher.get('a', {'_source': ['symbol']}, 'other')
+        self.assertEqual(batcher.stats['pending'], 5)
+        res = yield futures
+        self.assertEqual(res, [{'_id': 'a', 'symbol': 'A'}, None, {'_id': 'a', 'symbol': 'A'}, {'_id': 'b', 'symbol': 'B'}])
+        yield other
+        self.assertEqual(sorted(self.esq.mgets), [(['a'], {'_source': ['symbol']}),
+                                                  (['a', 'nope', 'b'], {})])
+        self.assertEqual(batcher.stats, {'batches': 2, 'gets': 5, 'pending': 0})
+
+    @gen.coroutine
+    def _test_max_size(self):
+        batcher = GetBatcher(self.esq, window=10, max_size=2)
+        res = yield [batcher.get('a', {}, 'key'), batcher.get('b', {}, 'key')]
+        # sent without waiting for the window
+        self.assertEqual([doc['_id'] for doc in res], ['a', 'b'])
+        self.assertEqual(len(self.esq.mgets), 1)
+        pending = batcher.get('a', {}, 'key')
+        self.assertEqual(batcher.stats['pending'], 1)
+        yield batcher._flush('key')
+        yield pending
+
+    @gen.coroutine
+    def _test_errors(self):
+        batcher = GetBatcher(self.esq, window=0.01, max_size=10)
+        broken, ok = batcher.get('broken', {}, 'key'), batcher.get('a', {}, 'key')
+        with self.assertRaises(TransportError):
+            yield broken
+        self.assertEqual((yield ok)['_id'], 'a')
+        # the whole batch fails with the multi-get
+        futures = [batcher.get(bid, {}, 'key') for bid in ['fail', 'a']]
+        for future in futures:
+            with self.assertRaises(TransportError):
+                yield future
+
+
+class ScrollESQuery(object):
+    '''the parts of ESQuery used by ScrollRegistry.'''
+    def __init__(self):
+        self.prefetched = []
+        self.discarded = []
+
+    def _prefetch_scroll(self, scroll_id):
+        self.prefetched.append(scroll_id)
+
+    def _discard_scroll(self, scroll_id):
+        self.discarded.append(scroll_id)
+
+
+class ScrollRegistryTests(unittest.TestCase):
+    def setUp(self):
+        self.esq = ScrollESQuery()
+        self.reg = ScrollRegistry(self.esq, max_scrolls=4, max_client_scrolls=2, idle_timeout=60)
+
+    def res(self, scroll_id, n, total=30):
+        return {'_scroll_id': scroll_id, 'hits': {'total': total, 'hits': [{}] * n}}
+
+    def test_caps(self):
+        self.reg.open(self.res('s1', 10), client='a')
+        self.reg.open(self.res('s2', 10), client='a')
+        with self.assertRaises(QueryError):
+            self.reg.check('a')
+        self.reg.check('b')
+        # an export with 2 shards
+        self.reg.open_export('export', 2, client='b')
+        self.assertEqual(len(self.reg), 4)
+        with self.assertRaises(QueryError):
+            self.reg.check('c')
+        self.reg.close_export('export')
+        self.reg.check('c')
+        self.assertEqual(self.reg.stats, {'open': 2, 'opened': 4, 'exhausted': 0, 'expired': 0, 'rejected': 2})
+
+    def test_workers(self):
+        # each of 3 processes gets a third of the caps, rounded up
+        self.reg.set_workers(3)
+        self.reg.open(self.res('s1', 10), client='a')
+        with self.assertRaises(QueryError):
+            self.reg.check('a')
+        self.reg.open(self.res('s2', 10), client='b')
+        with self.assertRaises(QueryError):
+            self.reg.check('c')
+        # no prefetch with several processes
+        self.assertEqual(self.esq.prefetched, [])
+
+    def test_exhausted(self):
+        self.reg.open(self.res('s1', 10), client='a')
+        self.assertEqual(self.esq.prefetched, ['s1'])
+        self.reg.advance('s1', self.res('s1', 10))
+        self.assertFalse(self.reg.is_exhausted('s1'))
+        self.reg.advance('s1', self.res('s1', 10))
+        # all 30 hits returned, cleared before the client asks for more
+        self.assertTrue(self.reg.is_exhausted('s1'))
+        self.assertEqual((len(self.reg), self.esq.discarded), (0, ['s1']))
+        # a scroll opened by another process, ending with an empty batch
+        self.reg.advance('s2', self.res('s2', 10))
+        self.reg.advance('s2', self.res('s2', 0))
+        self.assertTrue(self.reg.is_exhausted('s2'))
+        self.assertEqual(self.reg.exhausted, 2)
+
+    def test_expire(self):
+        self.reg.open(self.res('s1', 10), client='a')
+        self.reg.open(self.res('s2', 10), client='a')
+        self.reg._scrolls['s1']['accessed'] -= 61
+        self.reg.check('a')
+        self.assertEqual((list(self.reg._scrolls), self.esq.discarded), (['s2'], ['s1']))
+        # only forgotten with several processes, it may be used by another one
+        self.reg.set_workers(2)
+        self.reg._scrolls['s2']['accessed'] -= 61
+        self.reg.expire()
+        self.assertEqual((len(self.reg), self.esq.discarded, self.reg.expired), (0, ['s1'], 2))
+
+
+class IndexMetadataTests(ESQueryTestCase):
+    def setUp(self):
+        super(IndexMetadataTests, self).setUp()
+        self.io_loop = IOLoop()
+
+    def tearDown(self):
+        self.io_loop.close()
+
+    def age(self):
+        # as if loaded before the refresh interval
+        self.esq._index_metadata['loaded'] -= biothing_settings.index_metadata_refresh_interval + 1
+
+    def test_cached(self):
+        # loaded once, at startup
+        self.assertEqual(self.esq.get_index_version(), 'index_1:1')
+        self.esq._get_index_metadata()
+        self.assertEqual(len([call for call in self.es.calls if call[0] == 'indices.get']), 1)
+
+    def test_refresh(self):
+        self.io_loop.run_sync(self._test_refresh)
+
+    def test_refresh_error(self):
+        self.io_loop.run_sync(self._test_refresh_error)
+
+    @gen.coroutine
+    def _test_refresh(self):
+        self.esq._query_cache.set('key', 'res')
+        self.esq._get_exact_match_fields()
+        # the same index, nothing is cleared
+        self.age()
+        self.esq._get_index_metadata()
+        yield gen.moment
+        self.assertEqual(len([call for call in self.es.calls if call[0] == 'indices.get']), 2)
+        self.assertEqual(self.esq._query_cache.get('key'), 'res')
+        # a new build: the old value until refreshed, then everything derived from the index is cleared
+        self.es.build = '2'
+        self.age()
+        self.assertEqual(self.esq.get_index_version(), 'index_1:1')
+        self.assertTrue(self.esq._index_metadata_refreshing)
+        yield gen.moment
+        self.assertEqual(self.esq.get_index_version(), 'index_1:2')
+        self.assertIsNone(self.esq._query_cache.get('key'))
+        self.assertIsNone(self.esq._exact_match_fields)
+        self.assertFalse(self.esq._index_metadata_refreshing)
+        # the alias moved to another index
+        self.es.index_name = 'index_2'
+        self.age()
+        self.esq._get_index_metadata()
+        yield gen.moment
+        self.assertEqual(self.esq.get_index_version(), 'index_2:2')
+
+    @gen.coroutine
+    def _test_refresh_error(self):
+        def fail(index):
+            raise TransportError('N/A', 'unreachable')
+        self.es.indices.get = fail
+        self.age()
+        self.esq._get_index_metadata()
+        yield gen.moment
+        # kept, and retried at the next interval
+        self.assertEqual(self.esq.get_index_version(), 'index_1:1')
+        self.assertFalse(self.esq._index_metadata_refreshing)
+        self.assertLess(time.time() - self.esq._index_metadata['loaded'], 1)
+
+
+class HealthTests(ESQueryTestCase):
+    def test_health(self):
+        self.es.docs = {biothing_settings.status_check_id: {'_source': {}}}
+        self.assertEqual(self.esq._check_health()['status'], 'ok')
+        self.es.cluster_status = 'yellow'
+        self.assertEqual(self.esq._check_health()['status'], 'degraded')
+        self.es.cluster_status = 'red'
+        self.assertEqual(self.esq._check_health()['status'], 'unhealthy')
+        self.es.cluster_status, self.es.docs = 'green', {}
+        self.assertEqual(self.esq._check_health()['status'], 'unhealthy')
+        # only a HEAD
+        self.assertEqual(set([call[0] for call in self.es.calls]), set(['indices.get', 'exists']))
+
+    def test_deep(self):
+        # a deep check goes through status_check
+        checked = []
+        self.esq.status_check = lambda bid: checked.append(bid)
+        self.assertEqual(self.esq._check_health(deep=True)['status'], 'unhealthy')
+        self.assertEqual(checked, [biothing_settings.status_check_id])
+        self.esq.status_check = lambda bid: {'_id': bid}
+        self.assertEqual(self.esq._check_health(deep=True)['status'], 'ok')
+        self.assertNotIn('exists', [call[0] for call in self.es.calls])
+
+
+class FakeConnection(Connection):
+    '''answers with a JSON body, hosts listed in "down" are unreachable.'''
+    down = []
+    requests = []
+
+    def perform_request(self, method, url, params=None, body=None, timeout=None, ignore=()):
+        self.requests.append((self.host, method, url, params, body))
+        if self.host in self.down:
+            raise ConnectionError('N/A', 'connection refused', None)
+        return 200, {'content-type': 'application/json'}, '{"took": 1, "hits": {"total": 0}}'
+
+
+class RawRequestTests(unittest.TestCase):
+    def setUp(self):
+        FakeConnection.down, FakeConnection.requests = [], []
+        self.es = Elasticsearch(['host1', 'host2'], connection_class=FakeConnection, randomize_hosts=False)
+
+    def test_escape_params(self):
+        self.assertEqual(escape_params({'from_': 10, 'size': 5, '_source': ['a', 'b'], 'version': True, 'q': None}),
+                         {'from': '10', 'size': '5', '_source': 'a,b', 'version': 'true'})
+
+    def test_raw(self):
+        res = perform_raw_request(self.es, 'POST', '/index/_search', params={'from_': 10}, body={'query': {'match_all': {}}})
+        self.assertEqual(res, '{"took": 1, "hits": {"total": 0}}')
+        host, method, url, params, body = FakeConnection.requests[-1]
+        self.assertEqual((method, url, params), ('POST', '/index/_search', {'from': '10'}))
+        self.assertEqual(json.loads(body.decode('utf-8')), {'query': {'match_all': {}}})
+        # a string body is sent as is
+        perform_raw_request(self.es, 'POST', '/index/_msearch', body='{}\n{"query": {}}\n')
+        self.assertEqual(FakeConnection.requests[-1][4], b'{}\n{"query": {}}\n')
+        # other requests are still decoded
+        self.assertEqual(self.es.search(index='index'), {'took': 1, 'hits': {'total': 0}})
+
+    def test_dead_host(self):
+        # retried on the other host, the dead one is then skipped
+        FakeConnection.down = ['http://host1:9200']
+        for i in range(3):
+            self.assertEqual(json.loads(perform_raw_request(self.es, 'GET', '/index/doc/1'))['took'], 1)
+        self.assertEqual([r[0] for r in FakeConnection.requests].count('http://host1:9200'), 1)
+        FakeConnection.down.append('http://host2:9200')
+        with self.assertRaises(ConnectionError):
+            perform_raw_request(self.es, 'GET', '/index/doc/1')
@@ -87,6 +87,11 @@ class BiothingTestHelperMixin(object):
             assert not (isinstance(d, dict) and 'error' in d), self.truncate(str(d), 100)
         return d
 
+    def get_header(self, res, name):
+        '''header name of res (a httplib2 or tornado response), None if missing.'''
+        headers = getattr(res, 'headers', res)
+        return headers.get(name.lower(), headers.get(name))
+
     def get_ok(self, url):
         res, con = self.h.request((url))
         assert res.status == 200, "%r != 200" % (res.status)
@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+'''
+Nose tests of the web layer utilities, on synthetic data (no ES needed).
+run as "nosetests biothings.tests.test_utils"
+'''
+import os
+import io
+import csv
+import json
+import datetime
+import time
+import random
+import unittest
+from unittest import mock
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+os.environ.setdefault('BIOTHING_CONFIG', 'biothings.settings.default')
+
+from biothings.utils.cache import LRUCache, SingleFlight, estimate_sizeof
+from biothings.utils.common import get_accepted_encodings
+from biothings.utils.dotfield import compose_dot_fields_by_paths, split_dot_fields
+from biothings.utils.jsonenc import JSON_ENCODERS, get_json_encoder
+from biothings.utils import ga
+from biothings.utils.tabular import CSVWriter, TSVWriter, get_value
+from biothings.www.api.es import FieldCatalog
+
+
+class LRUCacheTests(unittest.TestCase):
+    def test_get_set(self):
+        cache = LRUCache(max_entries=10)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_eviction_by_entries(self):
+        cache = LRUCache(max_entries=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')      # "b" is now the least recently used
+        cache.set('c', 3)
+        self.assertEqual(sorted(cache._data), ['a', 'c'])
+        self.assertEqual(cache.evictions, 1)
+
+    def test_eviction_by_bytes(self):
+        cache = LRUCache(max_entries=10, max_bytes=100)
+        cache.set('a', 'x', size=60)
+        cache.set('b', 'y', size=30)
+        cache.set('c', 'z', size=30)
+        self.assertEqual(sorted(cache._data), ['b', 'c'])
+        self.assertEqual(cache.stats['bytes'], 60)
+        # never fits
+        cache.set('d', 'w', size=101)
+        self.assertNotIn('d', cache)
+
+    def test_ttl(self):
+        cache = LRUCache(max_entries=10, ttl=0.05)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        time.sleep(0.1)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual((cache.expirations, len(cache), cache.stats['bytes']), (1, 0, 0))
+
+    def test_disabled(self):
+        cache = LRUCache(max_entries=0)
+        cache.set('a', 1)
+        self.assertIsNone(cache.get('a'))
+
+    def test_estimate_sizeof(self):
+        self.assertEqual(estimate_sizeof('{"a": 1}'), 8)
+        hits = [{'_id': str(i), 'name': 'gene {}'.format(i)} for i in range(1000)]
+        encoded = len(json.dumps({'hits': hits}))
+        # from a sample of the hits, scaled to the size of the decoded objects
+        self.assertTrue(encoded < estimate_sizeof({'hits': hits}) < 4 * encoded)
+
+
+class SingleFlightTests(unittest.TestCase):
+    def setUp(self):
+        self.io_loop = IOLoop()
+
+    def tearDown(self):
+        self.io_loop.close()
+
+    def test_coalesce(self):
+        self.io_loop.run_sync(self._test_coalesce)
+
+    def test_exception(self):
+        self.io_loop.run_sync(self._test_exception)
+
+    @gen.coroutine
+    def _test_coalesce(self):
+        flight = SingleFlight()
+        pending = Future()
+        calls = []
+
+        def fn():
+            calls.append(1)
+            return pending
+        first = flight.do('key', fn)
+        second = flight.do('key', fn)
+        self.assertIs(first, second)
+        self.assertEqual((len(calls), len(flight)), (1, 1))
+        pending.set_result('done')
+        res = yield [first, second]
+        self.assertEqual(res, ['done', 'done'])
+        yield gen.moment
+        # nothing is kept once done
+        self.assertEqual(len(flight), 0)
+        @gen.coroutine
+        def again():
+            return 'again'
+        res = yield flight.do('key', again)
+        self.assertEqual(res, 'again')
+        self.assertEqual(flight.stats['calls'], 2)
+        self.assertEqual(flight.stats['coalesced'], 1)
+
+    @gen.coroutine
+    def _test_exception(self):
+        flight = SingleFlight()
+
+        @gen.coroutine
+        def fail():
+            yield gen.moment
+            raise ValueError('boom')
+        future = flight.do('key', fail)
+        with self.assertRaises(ValueError):
+            yield future
+        yield gen.moment
+        self.assertEqual(len(flight), 0)
+
+
+class DotFieldTests(unittest.TestCase):
+    def test_lists(self):
+        doc = {'a': [{'b': 1}, {'b': 2, 'c': 3}, {}], 'd': {'e': [{'f': 4}, {'f': [5, 6]}]}, 'g': 7}
+        res = compose_dot_fields_by_paths(doc, split_dot_fields(['a.b', 'd.e.f', 'g', 'x.y']))
+        self.assertEqual(res, {'a.b': [1, 2], 'd.e.f': [4, [5, 6]], 'g': 7})
+        # the doc isn't modified
+        self.assertEqual(doc['a'], [{'b': 1}, {'b': 2, 'c': 3}, {}])
+
+    def test_missing(self):
+        doc = {'a': [{'c': 1}], 'g': 7}
+        self.assertIs(compose_dot_fields_by_paths(doc, split_dot_fields(['a.b'])), doc)
+
+
+class FieldCatalogTests(unittest.TestCase):
+    def setUp(self):
+        rnd = random.Random(42)
+        words = ['gene', 'name', 'symbol', 'id', 'go', 'bp', 'ensembl', 'refseq', 'rna', 'protein']
+
+        def properties(depth):
+            props = {}
+            for word in rnd.sample(words, 5):
+                if depth < 3 and rnd.random() < 0.3:
+                    props[word] = {'properties': properties(depth + 1)}
+                else:
+                    props[word] = {'type': 'string', 'index': rnd.choice(['no', 'not_analyzed', None])}
+            return props
+        self.catalog = FieldCatalog(properties(0), notes={'gene': 'a note'})
+
+    def linear_find(self, search=None, prefix=None):
+        # the filter of FieldsHandler before FieldCatalog
+        return [name for name in self.catalog.fields
+                if (search and search in name) or (prefix and name.startswith(prefix))]
+
+    def test_find(self):
+        names = list(self.catalog.fields)
+        for name in names:
+            for (i, j) in [(0, len(name)), (0, 2), (1, 4), (len(name) - 3, len(name))]:
+                part = name[i:j]
+                self.assertEqual(list(self.catalog.find(search=part)), self.linear_find(search=part))
+                self.assertEqual(list(self.catalog.find(prefix=part)), self.linear_find(prefix=part))
+                self.assertEqual(list(self.catalog.find(search=part, prefix='g')),
+                                 self.linear_find(search=part, prefix='g'))
+        self.assertEqual(list(self.catalog.find(search='nothing')), [])
+        self.assertEqual(names, sorted(names))
+
+    def test_fields(self):
+        for (name, field) in self.catalog.fields.items():
+            self.assertIn('include_in_all', field)
+            self.assertIn(field['type'], ('string', 'object'))
+        if 'gene' in self.catalog.fields:
+            self.assertEqual(self.catalog.fields['gene']['notes'], 'a note')
+
+
+class TabularTests(unittest.TestCase):
+    def test_get_value(self):
+        doc = {'a': {'b': [{'c': 1}, {'c': [2, 3]}, {}]}, 'x': 'y', 'd.e': 4}
+        self.assertEqual(get_value(doc, 'a.b.c'), [1, 2, 3])
+        self.assertEqual(get_value(doc, 'd.e'), 4)
+        self.assertIsNone(get_value(doc, 'x.y'))
+        self.assertIsNone(get_value(doc, 'z'))
+
+    def test_tsv(self):
+        writer = TSVWriter(['_id', 'a', 'b'])
+        docs = [{'_id': '1', 'a': 'tab\there', 'b': 'new\nline\r'},
+                {'_id': '2', 'a': [1, 'x', None, True], 'b': {'k': 1.5}},
+                {'_id': '3'}]
+        self.assertEqual(writer.header(), b'_id\ta\tb\n')
+        self.assertEqual(writer.rows(docs).decode('utf-8'),
+                         '1\ttab here\tnew line \n'
+                         '2\t1|x|true\t{"k": 1.5}\n'
+                         '3\t\t\n')
+        self.assertEqual(writer.rows([]), b'')
+
+    def test_csv(self):
+        rnd = random.Random(1)
+        alphabet = ['a', ',', '"', '\n', '\r', ' ', '\t', u'é', '']
+        for trial in range(500):
+            columns = ['c{}'.format(i) for i in range(rnd.randint(2, 4))]
+            docs = [dict([(col, ''.join([rnd.choice(alphabet) for i in range(rnd.randint(0, 3))]))
+                          for col in columns if rnd.random() > 0.2])
+                    for j in range(rnd.randint(0, 4))]
+            buf = io.StringIO()
+            expected = csv.writer(buf, lineterminator='\n')
+            expected.writerow(columns)
+            expected.writerows([[doc.get(col, '') for col in columns] for doc in docs])
+            writer = CSVWriter(columns)
+            self.assertEqual((writer.header() + writer.rows(docs)).decode('utf-8'), buf.getvalue())
+
+
+class AcceptEncodingTests(unittest.TestCase):
+    def test_accepted(self):
+        self.assertEqual(get_accepted_encodings('gzip, deflate, br'), set(['gzip', 'deflate', 'br']))
+        self.assertEqual(get_accepted_encodings('zstd;q=0.5, GZIP;q=1.0'), set(['zstd', 'gzip']))
+        self.assertEqual(get_accepted_encodings('gzip;q=0, identity'), set(['identity']))
+        self.assertEqual(get_accepted_encodings('gzip; q=0.0'), set())
+        self.assertEqual(get_accepted_encodings(''), set())
+        self.assertEqual(get_accepted_encodings('gzip;q=x'), set(['gzip']))
+
+
+class FakeHTTPClient(object):
+    def __init__(self):
+        self.pending = []
+
+    def fetch(self, req, raise_error=True):
+        future = Future()
+        self.pending.append((req, future))
+        return future
+
+    def respond(self, error=None):
+        req, future = self.pending.pop(0)
+        future.set_result(mock.Mock(error=error))
+
+
+class GAQueueTests(unittest.TestCase):
+    def setUp(self):
+        self.io_loop = IOLoop()
+        self.queue = ga.GAQueue(max_size=3, batch_size=2, flush_interval=60)
+        self.queue._client = FakeHTTPClient()
+
+    def tearDown(self):
+        if self.queue._callback:
+            self.queue._callback.stop()
+        self.io_loop.close()
+
+    def test_drop(self):
+        self.io_loop.run_sync(self._test_drop)
+
+    def test_flush(self):
+        self.io_loop.run_sync(self._test_flush)
+
+    @gen.coroutine
+    def _test_drop(self):
+        self.assertEqual([self.queue.put(('/path', 'ip', 'ua', 'en', {})) for i in range(5)],
+                         [True, True, True, False, False])
+        self.assertEqual(self.queue.stats, {'queued': 3, 'pending': 0, 'sent': 0, 'failed': 0, 'dropped': 2})
+        # with the default (invalid) GA account, the requests can't be built
+        self.queue.flush()
+        self.assertEqual(self.queue.stats, {'queued': 0, 'pending': 0, 'sent': 0, 'failed': 3, 'dropped': 2})
+
+    @gen.coroutine
+    def _test_flush(self):
+        client = self.queue._client
+        with mock.patch.object(ga, 'build_ga_requests', side_effect=lambda path, *args: [path]):
+            for i in range(3):
+                self.queue.put(('/path/%s' % i, 'ip', 'ua', 'en', {}))
+            self.queue.flush()
+            # at most batch_size pending requests
+            self.assertEqual([req for (req, future) in client.pending], ['/path/0', '/path/1'])
+            self.queue.flush()
+            self.assertEqual(len(client.pending), 2)
+            client.respond()
+            client.respond(error=Exception('GA is down'))
+            yield gen.moment
+            self.assertEqual(self.queue.stats, {'queued': 1, 'pending': 0, 'sent': 1, 'failed': 1, 'dropped': 0})
+            self.queue.flush()
+            self.assertEqual([req for (req, future) in client.pending], ['/path/2'])
+
+
+class JSONEncoderTests(unittest.TestCase):
+    def test_fallback(self):
+        data = {'b': [1, 2 ** 70, -2 ** 65, 1.5, None, True], 'a': u'é/"\n',
+                'date': datetime.datetime(2016, 1, 2, 3, 4, 5), 'nested': {1: 'int key'}}
+        expected = json.loads(get_json_encoder('json')(data))
+        self.assertEqual(expected['b'][1], 2 ** 70)
+        self.assertEqual(expected['date'], '2016-01-02T03:04:05')
+        # every installed backend, falling back to stdlib for what it can't encode
+        for backend in sorted(JSON_ENCODERS):
+            for indent in (None, 2):
+                res = get_json_encoder(backend)(data, indent=indent)
+                self.assertEqual(json.loads(res), expected, backend)
+                self.assertEqual('\n' in res, bool(indent), backend)
+                self.assertLess(res.index('"a"'), res.index('"b"'), backend)
+
+    def test_backend(self):
+        self.assertIn(get_json_encoder('auto')({'a': 1}), ('{"a":1}', '{"a": 1}'))
+        with self.assertRaises(ValueError):
+            get_json_encoder('nope')
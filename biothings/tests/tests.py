@@ -558,6 +558,52 @@ class BiothingTests(unittest.TestCase, BiothingTestHelperMixin):
         # (testing failing status would require actually loading tornado app from there 
         #  and deal with config params...)
 
+    def test_status_codes(self):
+        # 200 when healthy or degraded, as HEAD too, and with a live check
+        for (url, method) in [('/status', 'GET'), ('/status', 'HEAD'), ('/status?deep=true', 'GET')]:
+            res, con = self.h.request(self.host + url, method)
+            assert res.status == 200, "%r for %s %s" % (res.status, method, url)
+            ok_(self.get_header(res, 'X-Health-Status') in ('ok', 'degraded'))
+        res, con = self.h.request(self.host + '/status')
+        eq_(con.decode('utf-8'), 'OK' if self.get_header(res, 'X-Health-Status') == 'ok' else 'DEGRADED')
+
+    def test_ndjson(self):
+        ids = [x.strip() for x in ns.annotation_POST[0]['ids'].split(',')]
+        headers = {'Content-type': 'application/x-www-form-urlencoded'}
+        res, con = self.h.request(self.api + '/' + ns.annotation_endpoint, 'POST',
+                                  urlencode({'ids': ','.join(ids), 'format': 'ndjson'}), headers=headers)
+        eq_(res.status, 200)
+        ok_(self.get_header(res, 'Content-Type').startswith('application/x-ndjson'))
+        lines = con.decode('utf-8').rstrip('\n').split('\n')
+        eq_([_d(line)['query'] for line in lines], ids)
+        # the same results as a JSON list
+        res_json = self.json_ok(self.post_ok(self.api + '/' + ns.annotation_endpoint, {'ids': ','.join(ids)}))
+        eq_([_d(line) for line in lines], res_json)
+
+    def test_etag(self):
+        url = self.api + '/' + ns.annotation_endpoint + '/' + ns.annotation_attribute_query
+        res, con = self.h.request(url)
+        etag = self.get_header(res, 'Etag')
+        ok_(etag)
+        res, con = self.h.request(url, headers={'If-None-Match': etag})
+        eq_(res.status, 304)
+        eq_(self.get_header(res, 'Etag'), etag)
+        # another request, another ETag
+        res, con = self.h.request(url + '?fields=_id', headers={'If-None-Match': etag})
+        eq_(res.status, 200)
+        # errors aren't cached with the ETag of the index, even when asked for
+        res, con = self.h.request(self.api + '/' + ns.query_endpoint + '?q=' + ns.query_GET[0] + '&size=x',
+                                  headers={'If-None-Match': etag})
+        ok_('error' in _d(con.decode('utf-8')))
+        ok_(not (self.get_header(res, 'Etag') or '').startswith('W/'))
+
+    def test_accept_encoding(self):
+        # no gzip with q=0
+        url = self.api + '/' + ns.query_endpoint + '?q=' + ns.query_GET[0]
+        res, con = self.h.request(url, headers={'Accept-Encoding': 'gzip;q=0, identity'})
+        eq_(res.status, 200)
+        ok_(self.get_header(res, 'Content-Encoding') is None)
+
     ###########################################################################
     # Convenience functions for adding new nosetests/ don't really need these...
     ###########################################################################
@@ -582,6 +628,7 @@ class BiothingTests(unittest.TestCase, BiothingTestHelperMixin):
         # tests included in base biothings suite
         tests = ['test_annotation_GET', 'test_annotation_POST', 'test_query_GET', 'test_query_POST',
                  'test_annotation_object', 'test_get_fields', 'test_main', 'test_metadata',
-                 'test_status_endpoint'] + extra_tests
+                 'test_status_endpoint', 'test_status_codes', 'test_ndjson', 'test_etag',
+                 'test_accept_encoding'] + extra_tests
         
         return unittest.TestSuite(map(cls, tests))
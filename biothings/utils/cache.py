@@ -0,0 +1,142 @@
+''' In-process caches used by the web layer. '''
+import json
+import time
+from collections import OrderedDict
+from tornado import gen
+
+
+# decoded Python objects take about this many times the size of their JSON text
+OBJECT_SIZE_RATIO = 2.2
+
+
+def _json_length(value, sample, depth):
+    if isinstance(value, list) and len(value) > sample:
+        # extrapolated from a few evenly spaced items
+        items = value[::len(value) // sample][:sample]
+        return sum([_json_length(item, sample, depth - 1) for item in items]) * len(value) // sample
+    if isinstance(value, dict) and depth > 0:
+        return sum([len(str(k)) + 4 + _json_length(v, sample, depth - 1) for (k, v) in value.items()])
+    try:
+        return len(json.dumps(value, default=str))
+    except (TypeError, ValueError):
+        return 0
+
+
+def estimate_sizeof(value, sample=5, depth=2):
+    ''' Estimate the memory footprint of a JSON-able value, cheaply: long lists (e.g. of
+        hits) are sized from sample of their items, and the JSON length is scaled by
+        OBJECT_SIZE_RATIO.  A str (e.g. an already encoded JSON document) is its length.
+    '''
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    return int(_json_length(value, sample, depth) * OBJECT_SIZE_RATIO)
+
+
+class LRUCache(object):
+    ''' A bounded LRU cache with optional TTL expiry.
+
+        Entries are evicted, least recently used first, when either max_entries or
+        max_bytes (as measured by sizeof) is exceeded.  Values are stored and returned
+        as-is, callers must not modify them.
+    '''
+    def __init__(self, max_entries=1000, max_bytes=None, ttl=None, sizeof=estimate_sizeof):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self._data = OrderedDict()      # key -> (value, size, expiration time)
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, _count=False) is not None
+
+    def _pop(self, key):
+        value, size, expires = self._data.pop(key)
+        self._bytes -= size
+        return value
+
+    def get(self, key, default=None, _count=True):
+        entry = self._data.get(key)
+        if entry is None:
+            if _count:
+                self.misses += 1
+            return default
+        if entry[2] is not None and entry[2] < time.time():
+            self._pop(key)
+            self.expirations += 1
+            if _count:
+                self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        if _count:
+            self.hits += 1
+        return entry[0]
+
+    def set(self, key, value, size=None):
+        if not self.max_entries:
+            return
+        if key in self._data:
+            self._pop(key)
+        size = self.sizeof(value) if size is None and self.max_bytes else (size or 0)
+        if self.max_bytes and size > self.max_bytes:
+            # would evict everything else and still not fit
+            return
+        expires = time.time() + self.ttl if self.ttl else None
+        self._data[key] = (value, size, expires)
+        self._bytes += size
+        while len(self._data) > self.max_entries or (self.max_bytes and self._bytes > self.max_bytes):
+            self._pop(next(iter(self._data)))
+            self.evictions += 1
+
+    def clear(self):
+        self._data.clear()
+        self._bytes = 0
+
+    @property
+    def stats(self):
+        return {'entries': len(self._data), 'bytes': self._bytes,
+                'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'expirations': self.expirations}
+
+
+class SingleFlight(object):
+    ''' Coalesce concurrent calls with the same key into one in-flight call.
+
+        do(key, fn) returns the future of the pending call for key if there is one,
+        otherwise calls fn() and shares its future until it resolves.  Nothing is kept
+        once the call is done, this is not a cache.
+    '''
+    def __init__(self):
+        self._inflight = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._inflight)
+
+    def do(self, key, fn):
+        future = self._inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return future
+        self.calls += 1
+        future = gen.convert_yielded(fn())
+        if not future.done():
+            self._inflight[key] = future
+            future.add_done_callback(lambda f: self._done(key, f))
+        return future
+
+    def _done(self, key, future):
+        if self._inflight.get(key) is future:
+            del self._inflight[key]
+
+    @property
+    def stats(self):
+        return {'calls': self.calls, 'coalesced': self.coalesced, 'inflight': len(self._inflight)}
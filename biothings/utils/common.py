@@ -248,6 +248,23 @@ def split_ids(q):
     return ids
 
 
+def get_accepted_encodings(accept_encoding):
+    '''return the set of content codings accepted in an Accept-Encoding header.'''
+    accepted = set()
+    for part in accept_encoding.split(','):
+        params = [p.strip() for p in part.split(';')]
+        q = 1.0
+        for param in params[1:]:
+            if param.startswith('q='):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    pass
+        if params[0] and q > 0:
+            accepted.add(params[0].lower())
+    return accepted
+
+
 def get_compressed_outfile(filename, compress='gzip'):
     '''Get a output file handler with given compress method.
        currently support gzip/bz2/lzma, lzma only available in py3
@@ -46,33 +46,62 @@ def parse_dot_fields(genedoc):
     return genedoc
 
 
+def split_dot_fields(fields):
+    """
+    return the [(field, [key1, key2...]), ...] paths of the dotted fields,
+    to be passed to compose_dot_fields_by_paths.
+      split_dot_fields(['a', 'b.c']) --> [('b.c', ['b', 'c'])]
+    """
+    return [(k, k.split('.')) for k in fields if k.find('.') != -1]
+
+
+_MISSING = object()
+
+
+def _get_path_value(value, path):
+    """
+    return the value at path in value, or _MISSING if not found.
+    lists met on the path are mapped over, e.g.:
+      _get_path_value({'a': [{'b': 1}, {'b': 2}, {}]}, ['a', 'b']) --> [1, 2]
+    """
+    for (i, k) in enumerate(path):
+        if isinstance(value, dict):
+            if k not in value:
+                return _MISSING
+            value = value[k]
+        elif isinstance(value, list):
+            values = [_get_path_value(v, path[i:]) for v in value]
+            values = [v for v in values if v is not _MISSING]
+            return values or _MISSING
+        else:
+            return _MISSING
+    return value
+
+
+def compose_dot_fields_by_paths(genedoc, paths):
+    """
+    same as compose_dot_fields_by_fields, with paths from split_dot_fields.
+    genedoc is not copied, only its requested paths are visited, and the
+    returned doc shares its values.
+    """
+    res = None
+    for (k, ks) in paths:
+        value = _get_path_value(genedoc, ks)
+        if value is _MISSING:
+            continue
+        if res is None:
+            res = dict(genedoc)
+        res.pop(ks[0], None)
+        res[k] = value
+
+    return res if res is not None else genedoc
+
+
 def compose_dot_fields_by_fields(genedoc, fields):
     """
     reverse funtion of parse_dot_fields
+      compose_dot_fields_by_fields({'a': {'b': 1, 'c': 2}, 'd': 3}, ['a.b', 'd'])
+    should return
+        {'a.b': 1, 'd': 3}
     """
-    res = None
-    to_del = set()
-    for k in fields:
-        if k.find('.') != -1:
-            if not res:
-                import copy
-                res = copy.deepcopy(genedoc)
-            ks = k.split('.')
-            broke = False
-            if ks[0] in genedoc:
-                t = genedoc[ks[0]]
-                for e in ks[1:]:
-                    if e in t:
-                        t = t[e]
-                    else:
-                        broke = True
-                        break
-                if broke:
-                    continue
-                to_del.add(ks[0])
-                res[k] = t
-
-    for k in to_del:
-        del res[k]
-
-    return res if res else genedoc
+    return compose_dot_fields_by_paths(genedoc, split_dot_fields(fields))
@@ -1,8 +1,22 @@
 from __future__ import print_function
 import time
 import json
-from elasticsearch import Elasticsearch, NotFoundError
+import threading
+from contextlib import contextmanager
+from elasticsearch import Elasticsearch, NotFoundError, RequestError, TransportError, ConnectionError
 from elasticsearch import helpers
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest, HTTPError
+from tornado.simple_httpclient import HTTPTimeoutError
+try:
+    # needs pycurl
+    from tornado.curl_httpclient import CurlAsyncHTTPClient
+except ImportError:
+    CurlAsyncHTTPClient = None
+try:
+    from urllib.parse import urlencode, quote
+except ImportError:
+    from urllib import urlencode, quote
 
 from biothings.utils.common import iter_n, timesofar, ask
 #from biothings.dataindex.mapping import get_mapping
@@ -50,6 +64,201 @@ def get_es(es_host):
     return es
 
 
+def escape_param(value):
+    # same convention as elasticsearch-py for url parameters
+    if isinstance(value, (list, tuple)):
+        return ','.join(value)
+    elif isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value)
+
+
+def escape_params(params):
+    '''the url parameters of params, with "from_" renamed "from" like in elasticsearch-py.'''
+    return dict([('from' if k == 'from_' else k, escape_param(v)) for (k, v) in params.items() if v is not None])
+
+
+def make_path(*parts):
+    return '/' + '/'.join([quote(str(p), safe=',') for p in parts if p not in (None, '')])
+
+
+class PassthroughDeserializer(object):
+    '''Wraps the deserializer of an elasticsearch Transport, so that the responses of the
+       requests made in its passthrough() context are returned as is, not decoded.
+       The context is per thread.
+    '''
+    def __init__(self, deserializer):
+        self.deserializer = deserializer
+        self._local = threading.local()
+
+    @contextmanager
+    def passthrough(self):
+        self._local.passthrough = True
+        try:
+            yield
+        finally:
+            self._local.passthrough = False
+
+    def loads(self, s, mimetype=None):
+        if getattr(self._local, 'passthrough', False):
+            return s
+        return self.deserializer.loads(s, mimetype)
+
+
+def perform_raw_request(es, method, path, params=None, body=None):
+    '''perform a request with the blocking client es, return the body of the ES response
+       as a string, not decoded.  The request goes through es.transport.perform_request,
+       with its retries, dead connection handling and sniffing, and raises the same exceptions.
+    '''
+    transport = es.transport
+    if not isinstance(transport.deserializer, PassthroughDeserializer):
+        transport.deserializer = PassthroughDeserializer(transport.deserializer)
+    if isinstance(body, bytes):
+        body = body.decode('utf-8')
+    with transport.deserializer.passthrough():
+        return transport.perform_request(method, path, params=escape_params(params or {}), body=body)
+
+
+def get_async_es(es_host, max_clients=100):
+    es = AsyncESClient(es_host, timeout=120, max_clients=max_clients)
+    return es
+
+
+class AsyncESClient(object):
+    '''A minimal non-blocking ES client running on tornado's AsyncHTTPClient.
+
+       Only the read calls needed by the web layer are implemented (get, mget, search,
+       msearch, scroll, clear_scroll, get_index, exists, cluster_health).  Each method returns a Future resolving to the
+       decoded ES response, and raises the same exceptions as the elasticsearch module
+       (NotFoundError, RequestError, TransportError).
+
+       Requests go round-robin over the hosts.  Like the elasticsearch module, a host that
+       can't be connected to is marked dead for dead_timeout seconds and skipped, and the
+       request is retried on the next one.
+
+       With pycurl installed, requests go through tornado's CurlAsyncHTTPClient, which keeps
+       connections to ES alive.  Without it, tornado's simple client opens a new connection
+       for every request.
+    '''
+    def __init__(self, es_host, timeout=120, max_clients=100, dead_timeout=60):
+        hosts = es_host if isinstance(es_host, (list, tuple)) else [es_host]
+        self._hosts = [h if h.startswith('http') else 'http://' + h for h in hosts]
+        self._host_idx = 0
+        self._dead = {}         # host -> time until which it's skipped
+        self.timeout = timeout
+        self.max_clients = max_clients
+        self.dead_timeout = dead_timeout
+        self._client = None
+
+    @property
+    def client(self):
+        # created lazily, so that it's bound to the IOLoop actually serving requests
+        if self._client is None:
+            if CurlAsyncHTTPClient is not None:
+                self._client = CurlAsyncHTTPClient(force_instance=True, max_clients=self.max_clients)
+            else:
+                self._client = AsyncHTTPClient(force_instance=True, max_clients=self.max_clients)
+        return self._client
+
+    def _get_host(self):
+        # round-robin over the live hosts, or the first dead one to come back if none is live
+        now = time.time()
+        for i in range(len(self._hosts)):
+            self._host_idx = (self._host_idx + 1) % len(self._hosts)
+            host = self._hosts[self._host_idx]
+            if self._dead.get(host, 0) <= now:
+                return host
+        return min(self._hosts, key=lambda h: self._dead[h])
+
+    def mark_dead(self, host):
+        self._dead[host] = time.time() + self.dead_timeout
+        logging.warning("ES host %s marked dead for %s seconds" % (host, self.dead_timeout))
+
+    def mark_live(self, host):
+        self._dead.pop(host, None)
+
+    @gen.coroutine
+    def perform_request(self, method, path, params=None, body=None, decode=True):
+        '''if decode is False, return the body of the ES response as a string, not decoded.'''
+        if params:
+            path += '?' + urlencode(escape_params(params))
+        if body is not None and not isinstance(body, (str, bytes)):
+            body = json.dumps(body)
+        for attempt in range(len(self._hosts)):
+            host = self._get_host()
+            req = HTTPRequest(host + path, method=method, body=body, request_timeout=self.timeout,
+                              headers={'Content-Type': 'application/json'},
+                              allow_nonstandard_methods=True)
+            try:
+                res = yield self.client.fetch(req)
+            except HTTPError as e:
+                info = e.response.body.decode('utf-8') if e.response is not None and e.response.body else str(e)
+                if e.code == 404:
+                    raise NotFoundError(e.code, info)
+                elif e.code == 400:
+                    raise RequestError(e.code, info)
+                elif e.code != 599:
+                    raise TransportError(e.code, info)
+                # curl error 28 is a timeout
+                elif isinstance(e, HTTPTimeoutError) or getattr(e, 'errno', None) == 28:
+                    raise TransportError('N/A', info)
+                error = ConnectionError('N/A', info, e)
+            except (OSError, IOError) as e:
+                # connection refused, host unreachable...
+                error = ConnectionError('N/A', str(e), e)
+            else:
+                self.mark_live(host)
+                break
+            self.mark_dead(host)
+        else:
+            raise error
+        if not decode:
+            return res.body.decode('utf-8')
+        if not res.body:
+            # e.g. HEAD requests
+            return {}
+        return json.loads(res.body.decode('utf-8'))
+
+    def get(self, index, id, doc_type='_all', **params):
+        return self.perform_request('GET', make_path(index, doc_type, id), params=params)
+
+    def mget(self, body, index=None, doc_type=None, **params):
+        return self.perform_request('POST', make_path(index, doc_type, '_mget'), params=params, body=body)
+
+    def search(self, index=None, doc_type=None, body=None, **params):
+        body = dict(body or {})
+        # sort given as a list of {field: order} dicts and aggs can only be sent in the body
+        if 'sort' in params and not isinstance(params['sort'], str):
+            body['sort'] = params.pop('sort')
+        if 'aggs' in params:
+            body['aggs'] = params.pop('aggs')
+        return self.perform_request('POST', make_path(index, doc_type, '_search'), params=params, body=body)
+
+    def msearch(self, body, index=None, doc_type=None, **params):
+        return self.perform_request('POST', make_path(index, doc_type, '_msearch'), params=params, body=body)
+
+    def scroll(self, scroll_id, **params):
+        return self.perform_request('POST', '/_search/scroll', params=params, body=scroll_id)
+
+    def clear_scroll(self, scroll_id, **params):
+        return self.perform_request('DELETE', '/_search/scroll', params=params, body=scroll_id)
+
+    def get_index(self, index, **params):
+        '''settings, mappings and aliases of index, like indices.get.'''
+        return self.perform_request('GET', make_path(index), params=params)
+
+    @gen.coroutine
+    def exists(self, index, id, doc_type='_all', **params):
+        try:
+            yield self.perform_request('HEAD', make_path(index, doc_type, id), params=params)
+        except NotFoundError:
+            return False
+        return True
+
+    def cluster_health(self, index=None, **params):
+        return self.perform_request('GET', make_path('_cluster', 'health', index), params=params)
+
+
 def wrapper(func):
     '''this wrapper allows passing index and doc_type from wrapped method.'''
     def outter_fn(*args, **kwargs):
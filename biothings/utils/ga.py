@@ -1,13 +1,130 @@
+from collections import deque
 from tornado.httpclient import HTTPRequest, AsyncHTTPClient
+from tornado.ioloop import PeriodicCallback
 from pyga.requests import (Tracker, Page, Session, Visitor,
                            Event, PageViewRequest, EventRequest)
 from biothings.settings import BiothingSettings
 
 biothing_settings = BiothingSettings()
 
+def build_ga_requests(path, remote_ip, user_agent, accept_language, event={}):
+    ''' Returns the HTTPRequests tracking a page view of path (and event, if any). '''
+    _req_list = []
+    visitor = Visitor()
+    visitor.ip_address = remote_ip
+    visitor.user_agent = user_agent
+    #get visitor.locale
+    visitor.extract_from_server_meta(
+        {"HTTP_ACCEPT_LANGUAGE": accept_language}
+    )
+    session = Session()
+    page = Page(path)
+    tracker = Tracker(biothing_settings.ga_account, biothing_settings.ga_tracker_url)
+    # tracker.track_pageview(page, session, visitor)  #this is non-async request
+    pvr = PageViewRequest(config=tracker.config,
+                          tracker=tracker,
+                          visitor=visitor,
+                          session=session,
+                          page=page)
+    r = pvr.build_http_request()
+    _req_list.append(HTTPRequest(r.get_full_url(),
+                                 "POST" if (r.data) else "GET",
+                                 headers=r.headers,
+                                 body=r.data))
+    if event:
+        evt = Event(**event)
+        #tracker.track_event(evt, session, visitor)  #this is non-async request
+        er = EventRequest(config=tracker.config,
+                          tracker=tracker,
+                          visitor=visitor,
+                          session=session,
+                          event=evt)
+        r = er.build_http_request()
+        _req_list.append(HTTPRequest(r.get_full_url(),
+                                     "POST" if (r.data) else "GET",
+                                     headers=r.headers,
+                                     body=r.data))
+    return _req_list
+
+
+class GAQueue(object):
+    ''' Bounded queue of the hits to send to google analytics.
+
+        Hits are dropped when the queue is full.  Every flush_interval seconds, up to
+        batch_size hits are turned into GA requests and sent with a single HTTP client
+        limited to max_clients connections (pyga's legacy protocol has no batch
+        request, so a batch is sent as concurrent requests).  "sent" and "failed"
+        count GA requests, "dropped" counts hits.
+    '''
+    def __init__(self, max_size=10000, batch_size=100, flush_interval=1, max_clients=10):
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_clients = max_clients
+        self._queue = deque()
+        self._client = None
+        self._callback = None
+        self._inflight = 0
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self._queue)
+
+    @property
+    def client(self):
+        # created lazily, so that it's bound to the IOLoop actually serving requests
+        if self._client is None:
+            self._client = AsyncHTTPClient(force_instance=True, max_clients=self.max_clients)
+        return self._client
+
+    def put(self, hit):
+        ''' queue hit, the args of build_ga_requests.  Returns False if it was dropped. '''
+        if len(self._queue) >= self.max_size:
+            self.dropped += 1
+            return False
+        self._queue.append(hit)
+        if self._callback is None:
+            self._callback = PeriodicCallback(self.flush, self.flush_interval * 1000)
+            self._callback.start()
+        return True
+
+    def flush(self):
+        ''' send the next batch of hits, keeping at most batch_size requests pending. '''
+        while self._queue and self._inflight < self.batch_size:
+            hit = self._queue.popleft()
+            try:
+                _req_list = build_ga_requests(*hit)
+            except Exception:
+                self.failed += 1
+                continue
+            for _req in _req_list:
+                self._inflight += 1
+                self.client.fetch(_req, raise_error=False).add_done_callback(self._on_done)
+
+    def _on_done(self, future):
+        self._inflight -= 1
+        if future.exception() or future.result().error:
+            self.failed += 1
+        else:
+            self.sent += 1
+
+    @property
+    def stats(self):
+        return {'queued': len(self._queue), 'pending': self._inflight, 'sent': self.sent,
+                'failed': self.failed, 'dropped': self.dropped}
+
+
+ga_queue = GAQueue(max_size=biothing_settings.ga_queue_size,
+                   batch_size=biothing_settings.ga_batch_size,
+                   flush_interval=biothing_settings.ga_flush_interval,
+                   max_clients=biothing_settings.ga_max_clients)
+
+
 class GAMixIn:
     def ga_track(self, event={}):
-        _req_list = []
+        ''' queue the tracking of this request (and event, if any), see GAQueue. '''
         no_tracking = self.get_argument('no_tracking', None)
         is_prod = biothing_settings.ga_is_prod
         if not no_tracking and is_prod and biothing_settings.ga_account:
@@ -15,43 +132,7 @@ class GAMixIn:
             remote_ip = _req.headers.get("X-Real-Ip",
                         _req.headers.get("X-Forwarded-For",
                         _req.remote_ip))
-            user_agent = _req.headers.get("User-Agent", None)
-            visitor = Visitor()
-            visitor.ip_address = remote_ip
-            visitor.user_agent = user_agent
-            #get visitor.locale
-            visitor.extract_from_server_meta(
-                {"HTTP_ACCEPT_LANGUAGE": _req.headers.get("Accept-Language", None)}
-            )
-            session = Session()
-            page = Page(_req.path)
-            tracker = Tracker(biothing_settings.ga_account, biothing_settings.ga_tracker_url)
-            # tracker.track_pageview(page, session, visitor)  #this is non-async request
-            pvr = PageViewRequest(config=tracker.config,
-                                  tracker=tracker,
-                                  visitor=visitor,
-                                  session=session,
-                                  page=page)
-            r = pvr.build_http_request()
-            _req_list.append(HTTPRequest(r.get_full_url(),
-                                         "POST" if (r.data) else "GET",
-                                         headers=r.headers,
-                                         body=r.data))
-            if event:
-                evt = Event(**event)
-                #tracker.track_event(evt, session, visitor)  #this is non-async request
-                er = EventRequest(config=tracker.config,
-                                  tracker=tracker,
-                                  visitor=visitor,
-                                  session=session,
-                                  event=evt)
-                r = er.build_http_request()
-                _req_list.append(HTTPRequest(r.get_full_url(),
-                                             "POST" if (r.data) else "GET",
-                                             headers=r.headers,
-                                             body=r.data))
-
-            #now send actual async requests
-            http_client = AsyncHTTPClient()
-            for _req in _req_list:
-                http_client.fetch(_req)
+            ga_queue.put((_req.path, remote_ip,
+                          _req.headers.get("User-Agent", None),
+                          _req.headers.get("Accept-Language", None),
+                          event))
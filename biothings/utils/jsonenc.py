@@ -0,0 +1,91 @@
+''' JSON encoder backends for the web layer.
+
+    get_json_encoder returns encode(data, indent=None) -> str for the requested backend:
+    "orjson" or "ujson" (fast C encoders, if installed), "json" (stdlib), or "auto" for
+    the fastest one installed.  The C encoders fall back to stdlib for the data they
+    can't encode (e.g. integers over 64 bits), so all backends accept the same data.
+'''
+import json
+import datetime
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+class RawJSON(str):
+    ''' An already encoded JSON document, e.g. an ES response passed through as is.
+        Written out without being encoded again. '''
+    def load(self):
+        return json.loads(self)
+
+
+class DateTimeJSONEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, datetime.datetime):
+            return obj.isoformat()
+        else:
+            return super(DateTimeJSONEncoder, self).default(obj)
+
+
+def _default(obj):
+    if isinstance(obj, datetime.datetime):
+        return obj.isoformat()
+    raise TypeError("Object of type {} is not JSON serializable".format(type(obj).__name__))
+
+
+def get_stdlib_encoder(sort_keys=True):
+    def encode(data, indent=None):
+        return json.dumps(data, cls=DateTimeJSONEncoder, indent=indent, sort_keys=sort_keys,
+                          separators=(',', ': ') if indent else (',', ':'))
+    return encode
+
+
+def get_orjson_encoder(sort_keys=True):
+    _encode = get_stdlib_encoder(sort_keys)
+    option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+    if sort_keys:
+        option |= orjson.OPT_SORT_KEYS
+
+    def encode(data, indent=None):
+        try:
+            # orjson only indents by 2 spaces
+            return orjson.dumps(data, default=_default,
+                                option=option | orjson.OPT_INDENT_2 if indent else option).decode('utf-8')
+        except TypeError:
+            return _encode(data, indent=indent)
+    return encode
+
+
+def get_ujson_encoder(sort_keys=True):
+    _encode = get_stdlib_encoder(sort_keys)
+
+    def encode(data, indent=None):
+        try:
+            return ujson.dumps(data, sort_keys=sort_keys, indent=indent or 0, ensure_ascii=False,
+                               escape_forward_slashes=False)
+        except (TypeError, OverflowError):
+            return _encode(data, indent=indent)
+    return encode
+
+
+JSON_ENCODERS = {'json': get_stdlib_encoder}
+if orjson:
+    JSON_ENCODERS['orjson'] = get_orjson_encoder
+if ujson:
+    JSON_ENCODERS['ujson'] = get_ujson_encoder
+
+
+def get_json_encoder(backend='auto', sort_keys=True):
+    ''' return the encode(data, indent=None) function of backend. '''
+    if backend == 'auto':
+        backend = [b for b in ['orjson', 'ujson', 'json'] if b in JSON_ENCODERS][0]
+    if backend not in JSON_ENCODERS:
+        raise ValueError('JSON encoder "{}" is not available (one of {})'.format(backend, ', '.join(sorted(JSON_ENCODERS))))
+    return JSON_ENCODERS[backend](sort_keys=sort_keys)
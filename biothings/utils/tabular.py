@@ -0,0 +1,213 @@
+''' Tabular output formats of biothing docs, one row per doc and one column per field.
+
+    TABLE_WRITERS maps each format to its TableWriter: "tsv", "csv", and "arrow" (Arrow IPC
+    stream) if pyarrow is installed.  Values are looked up by dotted field name, in nested
+    objects and lists of objects.  Lists are joined with "|", objects are JSON encoded, and
+    a missing value is an empty cell (a null in Arrow).
+'''
+import io
+import csv
+import json
+from operator import methodcaller
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+TABULAR_FORMATS = ['tsv', 'csv', 'arrow']
+LIST_SEPARATOR = '|'
+
+
+def _lookup(value, keys):
+    if not keys:
+        return value
+    if isinstance(value, list):
+        values = []
+        for item in value:
+            v = _lookup(item, keys)
+            if isinstance(v, list):
+                values.extend(v)
+            elif v is not None:
+                values.append(v)
+        return values or None
+    if isinstance(value, dict):
+        return _lookup(value.get(keys[0]), keys[1:])
+    return None
+
+
+def get_value(doc, field):
+    ''' the value of field (e.g. "a.b.c") in doc, a list if found in a list of objects. '''
+    return get_getter(field)(doc)
+
+
+def get_getter(field):
+    ''' the get_value function of field, compiled once per column. '''
+    if '.' not in field:
+        return methodcaller('get', field)
+    keys = field.split('.')
+
+    def getter(doc):
+        if field in doc:
+            # e.g. with dotfield=1
+            return doc[field]
+        value = doc
+        for (i, key) in enumerate(keys):
+            if type(value) is dict:
+                value = value.get(key)
+            else:
+                return _lookup(value, keys[i:])
+        return value
+    return getter
+
+
+def to_text(value):
+    ''' value as the text of a cell, None if missing. '''
+    if value is None or type(value) is str:
+        return value
+    elif type(value) in (int, float):
+        return str(value)
+    elif isinstance(value, bool):
+        return 'true' if value else 'false'
+    elif isinstance(value, list):
+        return LIST_SEPARATOR.join([to_text(v) for v in value if v is not None])
+    elif isinstance(value, dict):
+        return json.dumps(value, sort_keys=True)
+    return str(value)
+
+
+class TableWriter(object):
+    ''' Writes docs as the rows of a table with fixed columns.  header() is called once,
+        then rows(docs) for each batch of docs, then close(), each returning the next bytes
+        of the output, so a table can be written out incrementally.
+    '''
+    content_type = None
+    missing = None      # the text of a missing value
+
+    def __init__(self, columns):
+        self.columns = columns
+        self._getters = [get_getter(col) for col in columns]
+
+    def _columns(self, docs):
+        ''' the cells of docs, one list per column, filled in one pass per column. '''
+        missing = self.missing
+        return [[v if type(v) is str else (missing if v is None else to_text(v)) for v in map(getter, docs)]
+                for getter in self._getters]
+
+    def header(self):
+        return b''
+
+    def rows(self, docs):
+        raise NotImplementedError
+
+    def close(self):
+        return b''
+
+
+class DelimitedWriter(TableWriter):
+    ''' Rows of delimited cells, quoted as by the csv module. '''
+    delimiter = ','
+    missing = ''
+    _specials = ',"\r\n'      # the characters of a cell to be quoted
+
+    def _join(self, columns):
+        return ''.join([line + '\n' for line in map(self.delimiter.join, zip(*columns))]).encode('utf-8')
+
+    def _write(self, columns):
+        ''' the lines of the rows of columns (lists of cells). '''
+        texts = [''.join(col) for col in columns]
+        if len(columns) > 1 and not any([c in text for text in texts for c in self._specials]):
+            # nothing to quote (a single empty cell would be)
+            return self._join(columns)
+        buf = io.StringIO()
+        csv.writer(buf, delimiter=self.delimiter, lineterminator='\n').writerows(zip(*columns))
+        return buf.getvalue().encode('utf-8')
+
+    def header(self):
+        return self._write([[col] for col in self.columns])
+
+    def rows(self, docs):
+        return self._write(self._columns(docs))
+
+
+class CSVWriter(DelimitedWriter):
+    content_type = 'text/csv; charset=UTF-8'
+
+
+class TSVWriter(DelimitedWriter):
+    ''' TSV as text/tab-separated-values, not quoted: tabs and newlines in values are
+        replaced by spaces. '''
+    delimiter = '\t'
+    content_type = 'text/tab-separated-values; charset=UTF-8'
+    _blanks = {ord('\t'): ' ', ord('\n'): ' ', ord('\r'): ' '}
+
+    def _clean(self, cells):
+        text = ''.join(cells)
+        if '\t' in text or '\n' in text or '\r' in text:
+            return [cell.translate(self._blanks) for cell in cells]
+        return cells
+
+    def _write(self, columns):
+        return self._join([self._clean(col) for col in columns])
+
+
+class _BytesSink(object):
+    ''' a write-only file, returning what was written since the last take(). '''
+    closed = False
+
+    def __init__(self):
+        self._chunks = []
+        self._size = 0
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        self._size += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._size
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def writable(self):
+        return True
+
+    def take(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+class ArrowWriter(TableWriter):
+    ''' Arrow IPC stream of string columns (the same text as the TSV cells), one record
+        batch per batch of docs. '''
+    content_type = 'application/vnd.apache.arrow.stream'
+
+    def __init__(self, columns):
+        super(ArrowWriter, self).__init__(columns)
+        self.schema = pyarrow.schema([(col, pyarrow.string()) for col in columns])
+        self._sink = _BytesSink()
+        self._writer = pyarrow.ipc.new_stream(self._sink, self.schema)
+
+    def header(self):
+        return self._sink.take()
+
+    def rows(self, docs):
+        if docs:
+            arrays = [pyarrow.array(col, type=pyarrow.string()) for col in self._columns(docs)]
+            self._writer.write_batch(pyarrow.record_batch(arrays, schema=self.schema))
+        return self._sink.take()
+
+    def close(self):
+        self._writer.close()
+        return self._sink.take()
+
+
+TABLE_WRITERS = {'tsv': TSVWriter, 'csv': CSVWriter}
+if pyarrow:
+    TABLE_WRITERS['arrow'] = ArrowWriter
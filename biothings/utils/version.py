@@ -1,22 +1,14 @@
 ''' Functions to return versions of things. '''
 from subprocess import check_output
-from io import StringIO
-from contextlib import redirect_stdout
-import pip
+import pkg_resources
 import os
 import biothings
 
 def get_python_version():
-    ''' Get a list of python packages installed and their versions. '''
-    so = StringIO()
-
-    with redirect_stdout(so):
-        pip.main(['freeze'])
-    
-    if so.getvalue():
-        return so.getvalue().strip('\n').split('\n')
-    
-    return []
+    ''' Get a list of python packages installed and their versions ("name==version", as
+        pip freeze), from the installed distributions metadata. '''
+    return sorted(['{}=={}'.format(d.project_name, d.version) for d in pkg_resources.working_set],
+                  key=lambda x: x.lower())
 
 def get_biothings_commit():
     ''' Gets the biothings commit information. '''
@@ -41,3 +33,17 @@ def get_repository_information():
         commit_hash = ''
 
     return {'repository-url': repository_url, 'commit-hash': commit_hash}
+
+_software_info = None
+
+def get_software_info(refresh=False):
+    ''' Get the python packages, codebase and biothings commit information, collected
+        on first use then cached (collected again if refresh is True). '''
+    global _software_info
+    if _software_info is None or refresh:
+        _software_info = {
+            'python-package-info': get_python_version(),
+            'codebase': get_repository_information(),
+            'biothings': get_biothings_commit()
+        }
+    return _software_info
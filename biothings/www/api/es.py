@@ -1,10 +1,15 @@
-import json, logging, re
+import base64, bisect, json, logging, re, time
+from collections import OrderedDict
 from biothings.utils.common import dotdict, is_str, is_seq, find_doc
-from biothings.utils.es import get_es
-from elasticsearch import NotFoundError, RequestError
+from biothings.utils.cache import LRUCache, SingleFlight
+from biothings.utils.es import get_es, get_async_es, make_path, perform_raw_request
+from biothings.utils.jsonenc import RawJSON
+from elasticsearch import NotFoundError, RequestError, TransportError
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop, PeriodicCallback
 from biothings.settings import BiothingSettings
-from biothings.utils.dotfield import compose_dot_fields_by_fields as compose_dot_fields
-from collections import OrderedDict
+from biothings.utils.dotfield import compose_dot_fields_by_paths, split_dot_fields
 
 biothing_settings = BiothingSettings()
 
@@ -26,6 +31,24 @@ def parse_sort_option(options):
         options["sort"] = _sort_array
     return options
 
+def unique_ids(bid_list):
+    '''de-duplicate bid_list, keeping the input order.
+       return (unique_bids, idx), with bid_list[i] == unique_bids[idx[i]].
+    '''
+    seen = {}
+    unique_bids = []
+    idx = []
+    for bid in bid_list:
+        try:
+            i = seen.setdefault(bid, len(unique_bids))
+        except TypeError:
+            # unhashable (e.g. a list from jsoninput), don't de-duplicate
+            i = len(unique_bids)
+        if i == len(unique_bids):
+            unique_bids.append(bid)
+        idx.append(i)
+    return unique_bids, idx
+
 def parse_facets_option(kwargs):
     aggs = kwargs.pop('aggs', None)
     if aggs:
@@ -35,6 +58,13 @@ def parse_facets_option(kwargs):
         return _aggs
 
 
+# non-string field types matching exact values, whose fielddata values can be compared
+# with the query terms (unlike e.g. dates, returned as epoch millis, or doubles)
+EXACT_MATCH_TYPES = set(['long', 'integer', 'short', 'byte'])
+# ES index.max_result_window default
+ES_MAX_RESULT_WINDOW = 10000
+
+
 class QueryError(Exception):
     pass
 
@@ -43,40 +73,481 @@ class ScrollSetupError(Exception):
     pass
 
 
+class ScrollExport(object):
+    '''Iterates over all hits of a query, in batches, with one scroll per shard
+       (using "preference=_shards:<n>").  Shards are scrolled in turn.
+    '''
+    def __init__(self, esq, query, search_kwargs, options, n_shards):
+        self.esq = esq
+        self._query = query
+        self._search_kwargs = search_kwargs
+        self._options = options
+        self._shards = list(range(n_shards))
+        self._scroll_ids = {}
+        self.total = 0
+
+    def _shard_search_kwargs(self, shard):
+        kwargs = dict(self._search_kwargs)
+        kwargs['preference'] = '_shards:{}'.format(shard)
+        return kwargs
+
+    def _cleaned_batch(self, shard, res):
+        '''return the cleaned hits of a shard batch, an empty list when the shard is exhausted.'''
+        self._scroll_ids[shard] = res.get('_scroll_id')
+        if not res['hits']['hits']:
+            return []
+        self.total += len(res['hits']['hits'])
+        if self._options.raw:
+            return res['hits']['hits']
+        return [self.esq._get_biothingdoc(hit=hit, options=self._options) for hit in res['hits']['hits']]
+
+    def next(self):
+        '''return the next batch of hits, None when all shards are exhausted.'''
+        while self._shards:
+            shard = self._shards.pop(0)
+            if shard in self._scroll_ids:
+                res = self.esq._scroll(self._scroll_ids[shard])
+            else:
+                res = self.esq._search(self._query, **self._shard_search_kwargs(shard))
+            hits = self._cleaned_batch(shard, res)
+            if hits:
+                self._shards.append(shard)
+                return hits
+            self._clear(shard)
+        return None
+
+    def _clear(self, shard):
+        return self._clear_scroll_id(self._scroll_ids.pop(shard, None))
+
+    def _clear_scroll_id(self, scroll_id):
+        if scroll_id:
+            try:
+                self.esq._clear_scroll(scroll_id)
+            except Exception as e:
+                logging.debug("Can't clear scroll: %s" % e)
+
+    def close(self):
+        '''clear the scroll contexts left (e.g. if the client went away).'''
+        for shard in list(self._scroll_ids):
+            self._clear(shard)
+        self.esq._scrolls.close_export(self)
+
+
+class AsyncScrollExport(ScrollExport):
+    '''ScrollExport scrolling all shards in parallel.  Each shard prefetches its next
+       batch while the current one is consumed.
+    '''
+    def __init__(self, *args, **kwargs):
+        super(AsyncScrollExport, self).__init__(*args, **kwargs)
+        self._pending = dict([(shard, self.esq._search(self._query, **self._shard_search_kwargs(shard)))
+                              for shard in self._shards])
+
+    @gen.coroutine
+    def next(self):
+        while self._pending:
+            shards = list(self._pending)
+            wait = gen.WaitIterator(*[self._pending[shard] for shard in shards])
+            try:
+                res = yield wait.next()
+            finally:
+                shard = shards[wait.current_index]
+                del self._pending[shard]
+            hits = self._cleaned_batch(shard, res)
+            if hits:
+                # prefetch the next batch while this one is consumed
+                self._pending[shard] = self.esq._scroll(self._scroll_ids[shard])
+                return hits
+            yield self._clear(shard)
+        return None
+
+    @gen.coroutine
+    def _clear_scroll_id(self, scroll_id):
+        if scroll_id:
+            try:
+                yield self.esq._clear_scroll(scroll_id)
+            except Exception as e:
+                logging.debug("Can't clear scroll: %s" % e)
+
+    def close(self):
+        for future in self._pending.values():
+            # clear those scroll contexts once known
+            future.add_done_callback(self._clear_on_done)
+        self._pending = {}
+        super(AsyncScrollExport, self).close()
+
+    def _clear_on_done(self, future):
+        if not future.exception():
+            self._clear_scroll_id(future.result().get('_scroll_id'))
+
+
+class ScrollRegistry(object):
+    '''Bookkeeping of the scroll contexts opened by fetch_all queries.
+
+       Contexts are cleared in ES as soon as all their hits were returned, or once left
+       idle for idle_timeout seconds (checked on each scroll request), instead of
+       lingering until ES_SCROLL_TIME expires.  The number of open scrolls is capped,
+       globally and per client.  With a non-blocking ESQuery, the next batch of each
+       scroll is prefetched while the client consumes the current one.
+
+       The scrolls of a ScrollExport (one per shard) count against the caps until it's closed.
+
+       Each server process has its own registry, see set_workers.
+    '''
+    def __init__(self, esq, max_scrolls, max_client_scrolls, idle_timeout):
+        self.esq = esq
+        self.max_scrolls = max_scrolls
+        self.max_client_scrolls = max_client_scrolls
+        self.idle_timeout = idle_timeout
+        self.workers = 1
+        self._scrolls = OrderedDict()   # scroll_id -> entry, least recently used first
+        self._exports = {}              # ScrollExport -> (client, number of scrolls)
+        self._exhausted = LRUCache(max_entries=1000, ttl=idle_timeout)
+        self.opened = 0
+        self.exhausted = 0
+        self.expired = 0
+        self.rejected = 0
+
+    def __len__(self):
+        return len(self._scrolls) + sum([n for _, n in self._exports.values()])
+
+    def _client_count(self, client):
+        return len([e for e in self._scrolls.values() if e['client'] == client]) + \
+               sum([n for c, n in self._exports.values() if c == client])
+
+    def set_workers(self, workers):
+        '''set the number of server processes, each with its own registry.  The caps are
+           then shared between them.  With more than one, the batches of a scroll are
+           requested from any of them: no batch is prefetched (it could be requested from
+           another process), and idle scrolls are only forgotten, not cleared (they may be
+           in use elsewhere), their context expires in ES after ES_SCROLL_TIME.
+        '''
+        self.workers = max(workers, 1)
+
+    def _cap(self, cap):
+        # this process' share of cap
+        return -(-cap // self.workers) if cap else cap
+
+    def check(self, client=None):
+        '''raise QueryError if no more scroll can be opened by client.'''
+        self.expire()
+        max_scrolls = self._cap(self.max_scrolls)
+        max_client_scrolls = self._cap(self.max_client_scrolls)
+        if max_scrolls and len(self) >= max_scrolls:
+            self.rejected += 1
+            raise QueryError('Too many open scrolls, please retry later.')
+        if client and max_client_scrolls and self._client_count(client) >= max_client_scrolls:
+            self.rejected += 1
+            raise QueryError('Too many open scrolls for this client, please finish or wait for the previous ones.')
+
+    def open(self, res, client=None):
+        '''register the scroll context of a fetch_all query response.'''
+        if res.get('_scroll_id'):
+            self.opened += 1
+            self._update(res['_scroll_id'], {'client': client, 'total': None, 'seen': 0, 'prefetch': None}, res)
+
+    def open_export(self, export, n_scrolls, client=None):
+        '''count the n_scrolls scroll contexts of export until its close_export.'''
+        self.opened += n_scrolls
+        self._exports[export] = (client, n_scrolls)
+
+    def close_export(self, export):
+        self._exports.pop(export, None)
+
+    def is_exhausted(self, scroll_id):
+        return self._exhausted.get(scroll_id, _count=False) is not None
+
+    def take_prefetch(self, scroll_id):
+        '''return the prefetched next batch of scroll_id (a future), if any.'''
+        entry = self._scrolls.get(scroll_id)
+        if entry:
+            prefetch, entry['prefetch'] = entry['prefetch'], None
+            return prefetch
+
+    def advance(self, scroll_id, res, client=None):
+        '''account for a batch of scroll_id (scrolls opened elsewhere are registered).'''
+        entry = self._scrolls.pop(scroll_id, None)
+        if entry is None:
+            entry = {'client': client, 'total': None, 'seen': 0, 'prefetch': None}
+        self._update(res.get('_scroll_id') or scroll_id, entry, res)
+        self.expire()
+
+    def _update(self, scroll_id, entry, res):
+        hits = res.get('hits', {})
+        total = hits.get('total')
+        entry['total'] = total.get('value') if isinstance(total, dict) else total
+        entry['seen'] += len(hits.get('hits', []))
+        entry['accessed'] = time.time()
+        if not hits.get('hits') or (entry['total'] is not None and entry['seen'] >= entry['total']):
+            # nothing left, don't wait for the client to ask
+            self.exhausted += 1
+            self._exhausted.set(scroll_id, True)
+            self._clear(scroll_id, entry)
+        else:
+            self._scrolls[scroll_id] = entry
+            if self.workers == 1:
+                entry['prefetch'] = self.esq._prefetch_scroll(scroll_id)
+
+    def expire(self):
+        '''clear the scrolls left idle for more than idle_timeout.'''
+        deadline = time.time() - self.idle_timeout
+        while self._scrolls:
+            scroll_id, entry = next(iter(self._scrolls.items()))
+            if entry['accessed'] > deadline:
+                break
+            self.expired += 1
+            entry = self._scrolls.pop(scroll_id)
+            if self.workers == 1:
+                self._clear(scroll_id, entry)
+
+    def _clear(self, scroll_id, entry):
+        if entry['prefetch'] is not None:
+            # clear once the pending batch is in, it would be lost anyway
+            entry['prefetch'].add_done_callback(lambda f: self.esq._discard_scroll(scroll_id))
+        else:
+            self.esq._discard_scroll(scroll_id)
+
+    @property
+    def stats(self):
+        return {'open': len(self), 'opened': self.opened, 'exhausted': self.exhausted,
+                'expired': self.expired, 'rejected': self.rejected}
+
+
+class GetBatcher(object):
+    '''Merge the single doc GETs of AsyncESQuery arriving within window seconds into
+       one multi-get of up to max_size ids.  GETs are batched with those having the
+       same options, each caller gets its own doc (None if not found).
+    '''
+    def __init__(self, esq, window, max_size):
+        self.esq = esq
+        self.window = window
+        self.max_size = max_size
+        self._batches = {}      # options key -> {'options', 'pending': [(bid, future)], 'timeout'}
+        self.batches = 0
+        self.gets = 0
+
+    def get(self, bid, options, key):
+        future = Future()
+        batch = self._batches.get(key)
+        if batch is None:
+            batch = self._batches[key] = {'options': options, 'pending': [],
+                                          'timeout': IOLoop.current().call_later(self.window, self._flush, key)}
+        batch['pending'].append((bid, future))
+        if len(batch['pending']) >= self.max_size:
+            self._flush(key)
+        return future
+
+    @gen.coroutine
+    def _flush(self, key):
+        batch = self._batches.pop(key, None)
+        if batch is None:
+            return
+        IOLoop.current().remove_timeout(batch['timeout'])
+        options, pending = batch['options'], batch['pending']
+        self.batches += 1
+        self.gets += len(pending)
+        unique_bids, idx = unique_ids([bid for (bid, future) in pending])
+        try:
+            docs = yield self.esq._mget(body=self.esq._build_mget_body(unique_bids), index=self.esq._index,
+                                        doc_type=self.esq._doc_type, **self.esq._get_biothing_kwargs(options))
+        except Exception as e:
+            for (bid, future) in pending:
+                future.set_exception(e)
+            return
+        results = []
+        for doc in docs:
+            if 'error' in doc:
+                results.append(TransportError(500, doc['error']))
+            elif doc.get('found'):
+                try:
+                    results.append(self.esq._cleaned_get_res(doc, options))
+                except Exception as e:
+                    results.append(e)
+            else:
+                results.append(None)
+        for (i, (bid, future)) in enumerate(pending):
+            res = results[idx[i]]
+            if isinstance(res, Exception):
+                future.set_exception(res)
+            else:
+                future.set_result(res)
+
+    @property
+    def stats(self):
+        return {'batches': self.batches, 'gets': self.gets,
+                'pending': sum([len(batch['pending']) for batch in self._batches.values()])}
+
+
+class FieldCatalog(object):
+    '''The fields of an index mapping as served by FieldsHandler, i.e.
+       {dotted field: {'type', 'indexed', 'include_in_all'[, 'notes']}}, sorted by field.
+       Built once per mapping, prefix and substring lookups use sorted indexes of the
+       field names and of their suffixes.
+    '''
+    def __init__(self, properties, notes=None):
+        fields = self._flatten(properties, '')
+        for (k, v) in (notes or {}).items():
+            if k in fields:
+                fields[k]['notes'] = v
+        self.fields = OrderedDict(sorted(fields.items()))
+        self._names = list(self.fields)
+        self._suffixes = sorted([(name[i:], name) for name in self._names for i in range(len(name))])
+        self._json = {}
+
+    def _flatten(self, properties, prefix):
+        r = {}
+        for (k, v) in properties.items():
+            field = prefix + k
+            r[field] = {'indexed': False}
+            if 'properties' not in v:
+                r[field]['type'] = v['type']
+                if v.get('index') != 'no':
+                    # indexed field
+                    r[field]['indexed'] = True
+            else:
+                r[field]['type'] = 'object'
+                r.update(self._flatten(v['properties'], field + '.'))
+            r[field]['include_in_all'] = bool(v.get('include_in_all'))
+        return r
+
+    def _with_prefix(self, prefix):
+        i = bisect.bisect_left(self._names, prefix)
+        while i < len(self._names) and self._names[i].startswith(prefix):
+            yield self._names[i]
+            i += 1
+
+    def _containing(self, search):
+        i = bisect.bisect_left(self._suffixes, (search,))
+        while i < len(self._suffixes) and self._suffixes[i][0].startswith(search):
+            yield self._suffixes[i][1]
+            i += 1
+
+    def find(self, search=None, prefix=None):
+        '''return the fields containing search or starting with prefix.'''
+        names = set()
+        if search:
+            names.update(self._containing(search))
+        if prefix:
+            names.update(self._with_prefix(prefix))
+        return OrderedDict([(name, self.fields[name]) for name in sorted(names)])
+
+    def to_json(self, encode, indent=None):
+        '''return encode(self.fields, indent=indent), encoded once per indent.'''
+        if indent not in self._json:
+            self._json[indent] = encode(self.fields, indent=indent)
+        return self._json[indent]
+
+
 class ESQuery(object):
+    _export_class = ScrollExport
+    # last sort field of cursor pagination, must be unique per doc.
+    # None for "_uid" on ES 5.x and 6.x, "_id" on later versions.
+    _cursor_tiebreaker = None
+
     def __init__(self):
         self._es = get_es(biothing_settings.es_host)
+        # (major, minor) version of ES, see _get_es_version
+        self._es_version = None
         self._index = biothing_settings.es_index
         self._doc_type = biothing_settings.es_doc_type
         self._allowed_options = biothing_settings.allowed_options
         self._scroll_time = biothing_settings.scroll_time
         self._total_scroll_size = biothing_settings.scroll_size   # Total number of hits to return per scroll batch
         self._default_fields = []
+        self._query_cache = LRUCache(max_entries=biothing_settings.query_cache_max_entries,
+                                     max_bytes=biothing_settings.query_cache_max_bytes,
+                                     ttl=biothing_settings.query_cache_ttl)
+        # settings, mapping and _meta of the index, see _get_index_metadata
+        self._index_metadata = None
+        self._index_metadata_refreshing = False
+        self._exact_match_fields = None
+        self._field_catalog = None
+        # last health check, see get_health
+        self._health = None
+        self._health_callback = None
+        self._health_checking = False
+        # post-processing plans of hits, see _get_doc_plan
+        self._doc_plans = LRUCache(max_entries=1000)
+        self._scrolls = ScrollRegistry(self, max_scrolls=biothing_settings.es_max_scrolls,
+                                       max_client_scrolls=biothing_settings.es_max_client_scrolls,
+                                       idle_timeout=biothing_settings.es_scroll_idle_timeout)
         try:
             self._context = json.load(open(biothing_settings.jsonld_context_path, 'r'))
         except FileNotFoundError:
             self._context = {}
-        if self._total_scroll_size % self.get_number_of_shards() == 0:
+        # JSON-LD contexts indexed by doc path, see _add_jsonld_context
+        self._context_tree = self._compile_context_tree()
+        self._context_ref_tree = self._compile_context_tree(by_reference=True)
+        try:
+            # loaded at startup, as the index metadata, not to block later
+            self._get_es_version()
+        except Exception as e:
+            logging.warning("Can't get the ES version: %s" % e)
+        n_shards = self.get_number_of_shards()
+        if self._total_scroll_size % n_shards == 0:
             # Total hits per shard per scroll batch
-            self._scroll_size = int(self._total_scroll_size / self.get_number_of_shards())
+            self._scroll_size = int(self._total_scroll_size / n_shards)
         else:
             raise ScrollSetupError("_total_scroll_size of {} can't be ".format(self._total_scroll_size) +
-                                     "divided evenly among {} shards.".format(self.get_number_of_shards()))
-
-    def _traverse_biothingdoc(self, doc, context_key, options=None):
-        # Traverses through all levels of biothing doc to add jsonld context and sort the dictionaries
+                                     "divided evenly among {} shards.".format(n_shards))
+
+    def _get_context_url(self, context_key):
+        '''URL path of the JSON-LD context for context_key, served by JsonLdContextHandler.'''
+        prefix = '/' + biothing_settings._api_version if biothing_settings._api_version else ''
+        return '{}/context/{}.jsonld'.format(prefix, context_key)
+
+    def _compile_context_tree(self, by_reference=False):
+        '''return the JSON-LD context file as a tree following the doc structure:
+           {'@context': <context of this node, if any>, 'children': {key: subtree}}.
+           The context file is keyed by "root", "key", "key/subkey"...
+           With by_reference, contexts are given by their URL.
+        '''
+        tree = {'children': {}}
+        for (context_key, context) in self._context.items():
+            node = tree
+            if context_key != 'root':
+                for key in context_key.split('/'):
+                    node = node['children'].setdefault(key, {'children': {}})
+            node['@context'] = self._get_context_url(context_key) if by_reference else context['@context']
+        return tree
+
+    def get_jsonld_context(self, context_key):
+        '''return the JSON-LD context document for context_key, None if unknown.'''
+        return self._context.get(context_key)
+
+    def _add_jsonld_context(self, doc, node):
+        '''add the @context of node and its children to doc, in place.
+           only the doc paths with a context are visited.
+        '''
         if isinstance(doc, list):
-            return [self._traverse_biothingdoc(d, context_key, options) for d in doc]
+            for d in doc:
+                self._add_jsonld_context(d, node)
         elif isinstance(doc, dict):
-            this_list = []
-            if context_key in self._context and options and options.jsonld:
-                doc['@context'] = self._context[context_key]['@context']
-            for key in sorted(doc):
-                new_key = key if context_key == 'root' else context_key + '/' + key
-                this_list.append( (key, self._traverse_biothingdoc(doc[key], new_key, options)) )
-            return OrderedDict(this_list)
-        else:
-            return doc
+            if '@context' in node:
+                doc['@context'] = node['@context']
+            for (key, child) in node['children'].items():
+                if key in doc:
+                    self._add_jsonld_context(doc[key], child)
+
+    def _get_doc_plan(self, options):
+        '''return the plan (dot_fields, context_tree) used to post-process every hit
+           of a request, compiled once per (fields, jsonld, dotfield) combination:
+               dot_fields: the split dotted fields to compose with compose_dot_fields_by_paths, or None
+               context_tree: the JSON-LD context tree to add, or None
+        '''
+        fields = options.kwargs.fields or options.kwargs._source
+        fields = tuple(fields) if is_seq(fields) else fields
+        key = (fields, bool(options.jsonld), bool(options.dotfield))
+        plan = self._doc_plans.get(key)
+        if plan is None:
+            dot_fields = None
+            if options.dotfield and fields:
+                dot_fields = split_dot_fields(fields) or None
+            context_tree = None
+            if options.jsonld and self._context:
+                context_tree = self._context_ref_tree if biothing_settings.jsonld_context_by_reference else self._context_tree
+            plan = (dot_fields, context_tree)
+            self._doc_plans.set(key, plan)
+        return plan
 
     def _get_biothingdoc(self, hit, options=None):
         doc = hit.get('_source', hit.get('fields', {}))
@@ -89,13 +560,14 @@ class ESQuery(object):
             # if found is false, pass that to the doc
             doc['found'] = hit['found']
         #TODO: normalize, either _source or fields...
-        fields = options.kwargs.fields or options.kwargs._source
-        if options and options.dotfield and options.kwargs and fields:
-            doc = compose_dot_fields(doc,fields)  
+        dot_fields, context_tree = self._get_doc_plan(options)
+        if dot_fields:
+            doc = compose_dot_fields_by_paths(doc, dot_fields)
         # add other keys to object, if necessary
         doc = self._modify_biothingdoc(doc=doc, options=options)
-        # Sort keys, and add jsonld
-        doc = self._traverse_biothingdoc(doc=doc, context_key='root', options=options)
+        # add jsonld, keys are sorted when encoded
+        if context_tree:
+            self._add_jsonld_context(doc, context_tree)
         return doc
 
     def _modify_biothingdoc(self, doc, options=None):
@@ -219,7 +691,9 @@ class ESQuery(object):
 
     def _get_cleaned_query_options(self, kwargs):
         """common helper for processing fields, kwargs and other options passed to ESQueryBuilder."""
+        cursor = kwargs.pop('cursor', None)
         options = self._get_cleaned_common_options(kwargs)
+        options.cursor = cursor
         fields = kwargs.pop('fields', None)
         # this will force returning default fields if none were passed
         fields = self._cleaned_fields(fields)
@@ -240,11 +714,63 @@ class ESQuery(object):
         options.kwargs = kwargs
         return options
 
+    def _parse_index_metadata(self, r):
+        '''the index metadata from an indices.get response.'''
+        index = list(r.keys())[0]
+        mapping = r[index]['mappings'][self._doc_type]
+        _meta = mapping.get('_meta', {})
+        build = _meta.get('build_version') or _meta.get('timestamp') or json.dumps(_meta, sort_keys=True)
+        return {'index': index,
+                'settings': r[index]['settings'],
+                'mapping': mapping,
+                'meta': _meta,
+                # changes when the index is rebuilt, or when the alias points to another index
+                'version': (index, build),
+                'loaded': time.time()}
+
+    def _load_index_metadata(self):
+        return self._parse_index_metadata(self._es.indices.get(index=self._index))
+
+    def _set_index_metadata(self, metadata):
+        if self._index_metadata and self._index_metadata['version'] != metadata['version']:
+            logging.info("Index changed to %s, clearing cached results" % (metadata['version'],))
+            self._clear_index_state()
+        self._index_metadata = metadata
+
+    def _clear_index_state(self):
+        '''clear everything derived from the previous index.'''
+        self._query_cache.clear()
+        self._exact_match_fields = None
+        self._field_catalog = None
+
+    def _get_index_metadata(self):
+        '''return the cached settings, mapping and _meta of the index.
+           Loaded on first use, then refreshed in the background (on the IOLoop) once older
+           than INDEX_METADATA_REFRESH_INTERVAL seconds, the current value is returned meanwhile.
+        '''
+        if self._index_metadata is None:
+            self._set_index_metadata(self._load_index_metadata())
+        elif not self._index_metadata_refreshing and \
+             time.time() - self._index_metadata['loaded'] > biothing_settings.index_metadata_refresh_interval:
+            self._index_metadata_refreshing = True
+            IOLoop.current().add_callback(self._refresh_index_metadata)
+        return self._index_metadata
+
+    def _refresh_index_metadata(self):
+        try:
+            self._set_index_metadata(self._load_index_metadata())
+        except Exception as e:
+            logging.warning("Can't refresh index metadata: %s" % e)
+            self._index_metadata['loaded'] = time.time()    # retry at next interval
+        finally:
+            self._index_metadata_refreshing = False
+
+    def get_index_version(self):
+        '''a string identifying the index build, changes when the index is rebuilt.'''
+        return '{}:{}'.format(*self._get_index_metadata()['version'])
+
     def get_number_of_shards(self):
-        r = self._es.indices.get_settings(self._index)
-        n_shards = r[list(r.keys())[0]]['settings']['index']['number_of_shards']
-        n_shards = int(n_shards)
-        return n_shards
+        return int(self._get_index_metadata()['settings']['index']['number_of_shards'])
 
     def exists(self, bid):
         """return True/False if a biothing id exists or not."""
@@ -254,46 +780,192 @@ class ESQuery(object):
         except NotFoundError:
             return False
 
+    def _get_biothing_kwargs(self, options):
+        '''ES params for a single doc GET.'''
+        return {"_source": options.kwargs["_source"]} if "_source" in options.kwargs else {}
+
+    def _cleaned_get_res(self, res, options):
+        if options.raw:
+            return res
+        return self._get_biothingdoc(res, options=options)
+
+    def _use_passthrough(self, options):
+        '''True if the ES response is returned as is (raw output, no scroll or cursor to set
+           up from it), it's then passed through not decoded, see ES_RAW_PASSTHROUGH.
+        '''
+        return biothing_settings.es_raw_passthrough and options.raw and not (options.fetch_all or options.cursor)
+
+    def _raw_request(self, method, path, params=None, body=None):
+        '''return the body of the ES response as RawJSON, not decoded.'''
+        return RawJSON(perform_raw_request(self._es, method, path, params=params, body=body))
+
+    def _get_raw(self, bid, options):
+        return self._raw_request('GET', make_path(self._index, self._doc_type, bid), params=self._get_biothing_kwargs(options))
+
     def get_biothing(self, bid, **kwargs):
         '''unknown vid return None'''
         options = self._get_cleaned_annotation_options(kwargs)
-        kwargs = {"_source": options.kwargs["_source"]} if "_source" in options.kwargs else {}
         try:
-            res = self._es.get(index=self._index, id=bid, doc_type=self._doc_type, **kwargs)
+            if self._use_passthrough(options):
+                res = self._get_raw(bid, options)
+            else:
+                res = self._es.get(index=self._index, id=bid, doc_type=self._doc_type, **self._get_biothing_kwargs(options))
         except NotFoundError:
             return
 
-        if options.raw:
-            return res
-
-        res = self._get_biothingdoc(res, options=options)
-        return res
+        return self._cleaned_get_res(res, options)
 
     def _msearch(self,**kwargs):
         return self._es.msearch(**kwargs)['responses']
 
-    def mget_biothings(self, bid_list, **kwargs):
-        '''for /query post request'''
-        options = self._get_cleaned_annotation_options(kwargs)
-        qbdr = self._get_query_builder(**options.kwargs)
+    def _mget(self, **kwargs):
+        return self._es.mget(**kwargs)['docs']
+
+    def _is_id_scope(self, options):
+        '''True if the query terms are to be matched against _id only: scopes is "_id", or
+           isn't given and the query builder's build_id_query isn't overridden (an override
+           may match other fields by default).
+        '''
+        if options.scopes == '_id':
+            return True
+        return options.scopes is None and self._get_query_builder(**options.kwargs).has_default_id_query()
+
+    def _build_mget_body(self, bid_list):
+        return {'ids': ["{}".format(bid) for bid in bid_list]}
+
+    def _get_exact_match_fields(self):
+        '''return the set of fields (dotted paths) only matching exact values,
+           i.e. not_analyzed strings and integer types, from the index mapping.
+        '''
+        if self._exact_match_fields is None:
+            fields = set()
+
+            def is_exact(v):
+                return v.get('index') != 'no' and \
+                       ((v.get('type', 'string') == 'string' and v.get('index') == 'not_analyzed') or
+                        v.get('type') in EXACT_MATCH_TYPES)
+
+            def walk(properties, prefix):
+                for (k, v) in properties.items():
+                    if 'properties' in v:
+                        walk(v['properties'], prefix + k + '.')
+                        continue
+                    if is_exact(v):
+                        fields.add(prefix + k)
+                    for (sub_k, sub_v) in v.get('fields', {}).items():
+                        if is_exact(sub_v):
+                            fields.add(prefix + k + '.' + sub_k)
+            walk(self.query_fields(), '')
+            self._exact_match_fields = fields
+        return self._exact_match_fields
+
+    def _use_terms_query(self, options):
+        '''True if the query terms can be sent in batched terms queries, i.e. all scopes are
+           exact match fields, and the query builder's build_id_query isn't overridden (the
+           terms queries wouldn't match the same docs).
+        '''
+        if not biothing_settings.batch_terms_query or not options.scopes or self._is_id_scope(options) or options.rawquery:
+            return False
+        if not self._get_query_builder(**options.kwargs).has_default_id_query():
+            return False
+        scopes = [options.scopes] if is_str(options.scopes) else options.scopes
         try:
-            _q = qbdr.build_multiple_id_query(bid_list, scopes=options.scopes)
-        except QueryError as err:
-            return {'success': False,
-                    'error': err.message}
-        if options.rawquery:
-            return _q
+            exact_fields = self._get_exact_match_fields()
+        except Exception as e:
+            logging.warning("Can't get index mapping, not batching terms: %s" % e)
+            return False
+        return all([scope in exact_fields for scope in scopes])
+
+    def _build_terms_query(self, bid_list, options):
+        '''return (chunks, msearch body) for a terms query on each chunk of bid_list.'''
+        qbdr = self._get_query_builder(**options.kwargs)
+        chunk_size = biothing_settings.batch_terms_query_chunk_size
+        chunks = [bid_list[i:i + chunk_size] for i in range(0, len(bid_list), chunk_size)]
+        per_term_size = options.kwargs.get('size') or 10
+        _q = qbdr.build_multiple_terms_query(chunks, scopes=options.scopes,
+                                             size=min(chunk_size * per_term_size, ES_MAX_RESULT_WINDOW))
+        return chunks, _q
+
+    def _split_terms_res(self, chunks, res, options):
+        '''map the hits of each terms query back to their query terms.
+           return (responses, fallback) where responses is a list with one msearch-like
+           response per query term, None for the terms in fallback: the terms of chunks
+           that failed or were truncated, to query again one by one.  Integer values match
+           the terms of the same number (e.g. "007" matches 7).  If a hit of a chunk can't be
+           mapped back to any term, the terms of the chunk without hits are also in fallback
+           rather than reported as not found.
+        '''
+        scopes = [options.scopes] if is_str(options.scopes) else options.scopes
+        per_term_size = options.kwargs.get('size') or 10
+        responses = []
+        fallback = []
+        for (chunk, r) in zip(chunks, res):
+            if 'error' in r or r['hits']['total'] > len(r['hits']['hits']):
+                responses.extend([None] * len(chunk))
+                fallback.extend(chunk)
+                continue
+            term_pos = {}
+            for (i, bid) in enumerate(chunk):
+                term_pos.setdefault("{}".format(bid), []).append(i)
+                try:
+                    term_pos.setdefault(int(bid), []).append(i)
+                except (TypeError, ValueError):
+                    pass
+            _hits = [[] for bid in chunk]
+            unmapped = False
+            for hit in r['hits']['hits']:
+                matched = set()
+                for field in scopes:
+                    for value in hit.get('fields', {}).get(field, []):
+                        key = value if isinstance(value, int) and not isinstance(value, bool) else "{}".format(value)
+                        matched.update(term_pos.get(key, []))
+                hit.pop('fields', None)
+                unmapped = unmapped or not matched
+                for i in matched:
+                    if len(_hits[i]) < per_term_size:
+                        # each term gets its own copy, as query is set on it later
+                        _hits[i].append(dict(hit, _source=dict(hit.get('_source', {}))))
+            for (bid, h) in zip(chunk, _hits):
+                if h or not unmapped:
+                    responses.append({'hits': {'total': len(h), 'hits': h}})
+                else:
+                    responses.append(None)
+                    fallback.append(bid)
+        return responses, fallback
+
+    def _merge_fallback_res(self, responses, res):
+        '''fill the None responses of _split_terms_res with res, the responses for fallback.'''
+        res = iter(res)
+        return [r if r is not None else next(res) for r in responses]
+
+    def _terms_mget(self, bid_list, options):
+        '''msearch responses for bid_list, using batched terms queries.'''
+        chunks, _q = self._build_terms_query(bid_list, options)
         res = self._msearch(body=_q, index=self._index, doc_type=self._doc_type)
+        responses, fallback = self._split_terms_res(chunks, res, options)
+        if fallback:
+            res = self._msearch(body=self._build_mget_query(fallback, options), index=self._index, doc_type=self._doc_type)
+            responses = self._merge_fallback_res(responses, res)
+        return responses
+
+    def _build_mget_query(self, bid_list, options):
+        '''return the msearch body for bid_list. Raises QueryError.'''
+        qbdr = self._get_query_builder(**options.kwargs)
+        return qbdr.build_multiple_id_query(bid_list, scopes=options.scopes)
+
+    def _cleaned_mget_res(self, res, bid_list, idx, options):
+        '''merge msearch responses (one per unique query term) back with the input
+           query terms.  bid_list[i] was queried as res[idx[i]].
+        '''
         if options.raw:
             return res
 
-        assert len(res) == len(bid_list)
+        _hits = [self._cleaned_res(hits, empty=[], single_hit=False, options=options) for hits in res]
         _res = []
 
-        for i in range(len(res)):
-            hits = res[i]
+        for i in range(len(bid_list)):
+            hits = _hits[idx[i]]
             qterm = bid_list[i]
-            hits = self._cleaned_res(hits, empty=[], single_hit=False, options=options)
             if len(hits) == 0:
                 _res.append({u'query': qterm,
                              u'notfound': True})
@@ -306,6 +978,54 @@ class ESQuery(object):
                     _res.append(hit)
         return _res
 
+    def _mget_docs_as_responses(self, docs, options):
+        '''the docs returned by a multi-get as the msearch responses of _id match queries,
+           with a constant _score of 1.0.
+        '''
+        responses = []
+        for doc in docs:
+            if 'error' in doc:
+                responses.append({'error': doc['error']})
+            elif doc.get('found'):
+                hit = dict(doc, _score=1.0)
+                del hit['found']
+                if not options.kwargs.get('version'):
+                    hit.pop('_version', None)
+                responses.append({'hits': {'total': 1, 'max_score': 1.0, 'hits': [hit]}})
+            else:
+                responses.append({'hits': {'total': 0, 'max_score': None, 'hits': []}})
+        return responses
+
+    def _cleaned_mget_docs(self, docs, bid_list, idx, options):
+        '''same as _cleaned_mget_res, for the docs returned by a multi-get.'''
+        return self._cleaned_mget_res(self._mget_docs_as_responses(docs, options), bid_list, idx, options)
+
+    def mget_biothings(self, bid_list, **kwargs):
+        '''for /query post request'''
+        options = self._get_cleaned_annotation_options(kwargs)
+        unique_bids, idx = unique_ids(bid_list)
+        if self._is_id_scope(options):
+            # plain _id lookups, use a multi-get
+            body = self._build_mget_body(unique_bids)
+            if options.rawquery:
+                return json.dumps(body)
+            res = self._mget(body=body, index=self._index, doc_type=self._doc_type, **self._get_biothing_kwargs(options))
+            return self._cleaned_mget_docs(res, bid_list, idx, options)
+
+        try:
+            if self._use_terms_query(options):
+                # exact match scopes, batch terms in a few terms queries
+                res = self._terms_mget(unique_bids, options)
+                return self._cleaned_mget_res(res, bid_list, idx, options)
+            _q = self._build_mget_query(unique_bids, options)
+        except QueryError as err:
+            return {'success': False,
+                    'error': str(err)}
+        if options.rawquery:
+            return _q
+        res = self._msearch(body=_q, index=self._index, doc_type=self._doc_type)
+        return self._cleaned_mget_res(res, bid_list, idx, options)
+
     def _get_query_builder(self,**kwargs):
         '''Subclass to get a custom query builder'''
         return ESQueryBuilder(**kwargs) 
@@ -321,7 +1041,24 @@ class ESQuery(object):
         kwargs.update(scroll_options)
         return self._es.search(index=self._index, doc_type=self._doc_type, body=q, **kwargs)
 
-    def query(self, q, **kwargs):
+    def _search_raw(self, q, **kwargs):
+        '''the default _search, returning the ES response as RawJSON.'''
+        body = dict(q)
+        if not is_str(kwargs.get('sort', '')):
+            # a list of {field: order} can only be sent in the body
+            body['sort'] = kwargs.pop('sort')
+        return self._raw_request('POST', make_path(self._index, self._doc_type, '_search'), params=kwargs, body=body)
+
+    def _use_raw_search(self, options):
+        # a custom _search may change the query, only the default one is passed through
+        # (also if shadowed, see AsyncESQuery._warn_shadowed_overrides)
+        return self._use_passthrough(options) and \
+            all([cls in (ESQuery, AsyncESQuery) for cls in type(self).__mro__ if '_search' in vars(cls)])
+
+    def _get_query_args(self, q, kwargs):
+        '''clean q and kwargs, return (q, options, _query, scroll_options) for self._search.
+           Raises QueryError if the query can't be built.
+        '''
         # clean
         q = re.sub(u'[\t\n\x0b\x0c\r\x00]+', ' ', q)
         q = q.strip()
@@ -332,60 +1069,541 @@ class ESQuery(object):
         if options.fetch_all:
             #scroll_options.update({'search_type': 'scan', 'size': self._scroll_size, 'scroll': self._scroll_time})
             scroll_options.update({'size': self._total_scroll_size, 'scroll': self._scroll_time})
+        _query = self._build_query(q, kwargs)
+        if aggs:
+            _query['aggs'] = aggs
+        if options.cursor:
+            self._set_cursor_query(_query, kwargs, options)
+        return q, options, _query, scroll_options
+
+    def _encode_cursor(self, sort_values):
+        return base64.urlsafe_b64encode(json.dumps(sort_values).encode('utf-8')).decode('ascii')
+
+    def _decode_cursor(self, cursor):
         try:
-            _query = self._build_query(q, kwargs)
-            if aggs:
-                _query['aggs'] = aggs
-            res = self._search(_query,scroll_options=scroll_options,**options.kwargs)
-        except QueryError as e:
-            msg = str(e)
-            return {'success': False,
-                    'error': msg}
-        except RequestError as e:
-            return {"error": "invalid query term: %s" % repr(e), "success": False}
+            sort_values = json.loads(base64.urlsafe_b64decode(str(cursor).encode('ascii')).decode('utf-8'))
+        except (TypeError, ValueError):
+            sort_values = None
+        if not isinstance(sort_values, list):
+            raise QueryError('Invalid "cursor" value.')
+        return sort_values
+
+    def _get_es_version(self):
+        '''return the (major, minor) version of ES, loaded on first use.'''
+        if self._es_version is None:
+            number = self._es.info()['version']['number']
+            self._es_version = tuple([int(n) for n in number.split('.')[:2]])
+        return self._es_version
+
+    def _get_cursor_tiebreaker(self):
+        if self._cursor_tiebreaker:
+            return self._cursor_tiebreaker
+        return '_uid' if self._get_es_version() < (7, 0) else '_id'
+
+    def _set_cursor_query(self, _query, kwargs, options):
+        '''set up _query for a page of cursor pagination: hits are sorted by the requested
+           sort (or score) then by _get_cursor_tiebreaker(), and the page starts after the
+           sort values of the cursor (search_after).  cursor=true returns the first page.
+           Unlike from, the cost of a page doesn't grow with its depth.
+           Raises QueryError on ES < 5.0, which has no search_after.
+        '''
+        if options.fetch_all:
+            raise QueryError('"cursor" can not be used with "fetch_all".')
+        try:
+            es_version = self._get_es_version()
         except Exception as e:
-            # logging.debug("%s" % str(e))
+            logging.warning("Can't get the ES version: %s" % e)
+            raise QueryError('"cursor" is not available right now.')
+        if es_version < (5, 0):
+            raise QueryError('"cursor" is not supported by this server (needs Elasticsearch 5.0 or later).')
+        sort = kwargs.pop('sort', None) or [{'_score': 'desc'}]
+        _query['sort'] = list(sort) + [{self._get_cursor_tiebreaker(): 'asc'}]
+        kwargs.pop('from_', None)
+        if options.cursor not in (True, 'true', '1'):
+            _query['search_after'] = self._decode_cursor(options.cursor)
+
+    def _get_next_cursor(self, res, options):
+        '''return the cursor of the page following res, or None if res is the last page.'''
+        hits = res['hits']['hits']
+        try:
+            size = int(options.kwargs.get('size', 10))
+        except ValueError:
+            size = 10
+        if hits and len(hits) >= size and 'sort' in hits[-1]:
+            return self._encode_cursor(hits[-1]['sort'])
+
+    def _query_error(self, q, err):
+        '''return the error response for an exception raised while querying.'''
+        if isinstance(err, QueryError):
+            return {'success': False,
+                    'error': str(err)}
+        elif isinstance(err, RequestError):
+            return {"error": "invalid query term: %s" % repr(err), "success": False}
+        else:
+            # logging.debug("%s" % str(err))
             return {'success': False, 'error': "Something is wrong with query '%s'" % q}
 
+    def _cleaned_query_res(self, res, options):
         # if options.fetch_all:
         #     return res
-
+        next_cursor = self._get_next_cursor(res, options) if options.cursor else None
         if not options.raw:
             res = self._cleaned_res2(res, options=options)
+        if next_cursor:
+            res['next'] = next_cursor
         return res
 
-    def scroll(self, scroll_id, **kwargs):
-        '''return the results from a scroll ID, recognizes options.raw'''
-        options = self._get_cleaned_query_options(kwargs)
-        r = self._es.scroll(scroll_id, scroll=self._scroll_time)
+    def _query_cache_key(self, _query, options):
+        '''return the query cache key for this query, or None if it can't be cached.'''
+        if options.fetch_all or not self._query_cache.max_entries:
+            return None
+        self._get_index_metadata()      # clears the cache if the index changed
+        return json.dumps([_query, options], sort_keys=True, default=str)
+
+    def query(self, q, client=None, **kwargs):
+        '''client identifies the caller, to cap its open scrolls (fetch_all).'''
+        try:
+            q, options, _query, scroll_options = self._get_query_args(q, kwargs)
+            cache_key = self._query_cache_key(_query, options)
+            res = self._query_cache.get(cache_key) if cache_key else None
+            if res is not None:
+                return res
+            if options.fetch_all:
+                self._scrolls.check(client)
+            if self._use_raw_search(options):
+                res = self._search_raw(_query, **dict(options.kwargs))
+            else:
+                res = self._search(_query,scroll_options=scroll_options,**options.kwargs)
+        except Exception as e:
+            return self._query_error(q, e)
+
+        if options.fetch_all:
+            self._scrolls.open(res, client)
+        res = self._cleaned_query_res(res, options)
+        if cache_key:
+            self._query_cache.set(cache_key, res)
+        return res
+
+    def _cleaned_scroll_res(self, r, options):
         scroll_id = r.get('_scroll_id')
         if scroll_id is None or not r['hits']['hits']:
             return {'success': False, 'error': 'No results to return.'}
-        else:
-            if not options.raw:
-                res = self._cleaned_res2(r, options=options)
-            #res.update({'_scroll_id': scroll_id})
-            if r['_shards']['failed']:
-                res.update({'_warning': 'Scroll request has failed on {} shards out of {}.'.format(r['_shards']['failed'], r['_shards']['total'])})
+        if options.raw:
+            return r
+        res = self._cleaned_res2(r, options=options)
+        #res.update({'_scroll_id': scroll_id})
+        if r['_shards']['failed']:
+            res.update({'_warning': 'Scroll request has failed on {} shards out of {}.'.format(r['_shards']['failed'], r['_shards']['total'])})
         return res
 
+    def scroll(self, scroll_id, client=None, **kwargs):
+        '''return the results from a scroll ID, recognizes options.raw'''
+        options = self._get_cleaned_query_options(kwargs)
+        if self._scrolls.is_exhausted(scroll_id):
+            return {'success': False, 'error': 'No results to return.'}
+        r = self._scroll(scroll_id)
+        self._scrolls.advance(scroll_id, r, client)
+        return self._cleaned_scroll_res(r, options)
+
+    def _scroll(self, scroll_id):
+        return self._es.scroll(scroll_id, scroll=self._scroll_time)
+
+    def _clear_scroll(self, scroll_id):
+        return self._es.clear_scroll(scroll_id=scroll_id)
+
+    def _prefetch_scroll(self, scroll_id):
+        '''start fetching the next batch of scroll_id, return None if it can't be done
+           in the background.
+        '''
+        return None
+
+    def _discard_scroll(self, scroll_id):
+        '''clear a scroll context, ignoring errors (e.g. already expired).'''
+        try:
+            self._clear_scroll(scroll_id)
+        except Exception as e:
+            logging.debug("Can't clear scroll: %s" % e)
+
+    def _get_export_args(self, _query, options):
+        '''return (query, search kwargs) used by each shard scroll of an export.'''
+        _query = dict(_query)
+        _query.pop('aggs', None)
+        kwargs = dict(options.kwargs)
+        kwargs.pop('from_', None)
+        kwargs.update({'size': self._scroll_size, 'scroll': self._scroll_time})
+        return _query, kwargs
+
+    def export(self, q, client=None, **kwargs):
+        '''return a ScrollExport over all the hits of query q (or an error dict), with
+           one scroll per shard driven by the server.  client identifies the caller, to
+           cap its open scrolls.
+        '''
+        kwargs['fetch_all'] = True
+        try:
+            q, options, _query, scroll_options = self._get_query_args(q, kwargs)
+            self._scrolls.check(client)
+        except Exception as e:
+            return self._query_error(q, e)
+        _query, search_kwargs = self._get_export_args(_query, options)
+        n_shards = self.get_number_of_shards()
+        export = self._export_class(self, _query, search_kwargs, options, n_shards)
+        self._scrolls.open_export(export, n_shards, client)
+        return export
+
     def get_mapping_meta(self):
-        """ return the current _meta field."""
-        m = self._es.indices.get_mapping(index=self._index, doc_type=self._doc_type)
-        m = m[list(m.keys())[0]]['mappings'][self._doc_type]
-        return m.get('_meta', {})
+        """ return the current _meta field (a copy, top-level keys can be added)."""
+        return dict(self._get_index_metadata()['meta'])
 
     def query_fields(self, **kwargs):
-        # query the metadata to get the available fields for a biothing object
-        r = self._es.indices.get(index=self._index)
-        return r[list(r.keys())[0]]['mappings'][self._doc_type]['properties']
+        # the available fields for a biothing object, from the cached mapping (do not modify)
+        return self._get_index_metadata()['mapping']['properties']
+
+    def get_field_catalog(self):
+        '''return the FieldCatalog of the mapping, with the notes of FIELD_NOTES_PATH.'''
+        properties = self.query_fields()
+        if self._field_catalog is None:
+            if biothing_settings.field_notes_path:
+                notes = json.load(open(biothing_settings.field_notes_path, 'r'))
+            else:
+                notes = {}
+            self._field_catalog = FieldCatalog(properties, notes)
+        return self._field_catalog
 
     def status_check(self, bid):
         r = self.get_biothing(bid)
         return r
 
+    def _cleaned_health(self, doc_exists, cluster_status, error=None):
+        '''the health state from the checks: "unhealthy" if the STATUS_CHECK_ID doc can't be
+           found (or the cluster is red), "degraded" if the cluster health isn't green (or
+           unknown), otherwise "ok".
+        '''
+        if not doc_exists or cluster_status == 'red':
+            status = 'unhealthy'
+        elif cluster_status != 'green':
+            status = 'degraded'
+        else:
+            status = 'ok'
+        health = {'status': status, 'doc_found': bool(doc_exists), 'cluster': cluster_status, 'checked': time.time()}
+        if error:
+            health['error'] = error
+        self._health = health
+        return health
+
+    def _check_health(self, deep=False):
+        '''the background check only HEADs the STATUS_CHECK_ID doc, a deep check gets it
+           through status_check, as a client would.
+        '''
+        try:
+            if deep:
+                doc_exists = self.status_check(biothing_settings.status_check_id) is not None
+            else:
+                doc_exists = self._es.exists(index=self._index, doc_type=self._doc_type, id=biothing_settings.status_check_id)
+        except Exception as e:
+            return self._cleaned_health(False, None, error=str(e))
+        try:
+            cluster_status = self._es.cluster.health(index=self._index)['status']
+        except Exception as e:
+            return self._cleaned_health(doc_exists, 'unknown', error=str(e))
+        return self._cleaned_health(doc_exists, cluster_status)
+
+    def _refresh_health(self):
+        if self._health_checking:
+            return
+        self._health_checking = True
+        try:
+            self._check_health()
+        finally:
+            self._health_checking = False
+
+    def get_health(self, deep=False):
+        '''return the health state, {'status': "ok", "degraded" or "unhealthy", ...}, as of the
+           last background check (run every HEALTH_CHECK_INTERVAL seconds), or from a live
+           check through status_check if deep is True.
+        '''
+        if self._health_callback is None:
+            # started on first use, on the IOLoop serving requests
+            self._health_callback = PeriodicCallback(self._refresh_health, biothing_settings.health_check_interval * 1000)
+            self._health_callback.start()
+        if deep or self._health is None:
+            return self._check_health(deep=deep)
+        return self._health
+
+    def get_metrics(self):
+        '''return runtime counters, served by MetricsHandler.'''
+        self._scrolls.expire()
+        return {'query_cache': self._query_cache.stats,
+                'scrolls': self._scrolls.stats}
+
+    def reconnect(self):
+        '''use new ES clients, e.g. in a worker process forked after the index metadata was loaded.'''
+        self._es = get_es(biothing_settings.es_host)
+
+    def set_workers(self, workers):
+        '''set the number of server processes sharing the requests, see ScrollRegistry.set_workers.'''
+        self._scrolls.set_workers(workers)
+
+
+class AsyncESQuery(ESQuery):
+    '''ESQuery running the request path (get_biothing, mget_biothings, query, scroll)
+       on a non-blocking ES transport.  These methods are coroutines returning the same
+       results as their ESQuery counterparts, so a slow ES call no longer blocks the IOLoop.
+
+       Index metadata (get_mapping_meta, query_fields, get_number_of_shards) is loaded
+       with the blocking client at startup, then refreshed with the non-blocking one.
+
+       In "class AsyncESQuery(AsyncESQuery, ESQuery)" (as in the project template), the
+       methods of ESQuery overridden here shadow those of the project's ESQuery, a warning
+       is logged for each, see _warn_shadowed_overrides.
+    '''
+    _export_class = AsyncScrollExport
+
+    def __init__(self):
+        super(AsyncESQuery, self).__init__()
+        self._warn_shadowed_overrides()
+        self._async_es = get_async_es(biothing_settings.es_host, max_clients=biothing_settings.es_max_clients)
+        self._single_flight = SingleFlight()
+        self._get_batcher = None
+        if biothing_settings.es_get_batch_window:
+            self._get_batcher = GetBatcher(self, window=biothing_settings.es_get_batch_window / 1000.0,
+                                           max_size=biothing_settings.es_get_batch_size)
+
+    def _warn_shadowed_overrides(self):
+        '''log a warning for the methods of an ESQuery subclass mixed in after AsyncESQuery,
+           that are also overridden by AsyncESQuery and so never called.
+        '''
+        mro = type(self).__mro__
+        overridden = set([name for name in vars(AsyncESQuery) if not name.startswith('__')])
+        for cls in mro[mro.index(AsyncESQuery) + 1:]:
+            if cls is ESQuery or not issubclass(cls, ESQuery):
+                continue
+            for name in sorted(overridden.intersection(vars(cls))):
+                logging.warning("%s.%s is shadowed by AsyncESQuery.%s, override it in %s instead" %
+                                (cls.__name__, name, name, type(self).__name__))
+
+    @gen.coroutine
+    def _refresh_index_metadata(self):
+        try:
+            r = yield self._async_es.get_index(self._index)
+            self._set_index_metadata(self._parse_index_metadata(r))
+        except Exception as e:
+            logging.warning("Can't refresh index metadata: %s" % e)
+            self._index_metadata['loaded'] = time.time()    # retry at next interval
+        finally:
+            self._index_metadata_refreshing = False
+
+    def _coalesce(self, key, fn, *args):
+        '''return the future of fn(*args), shared with the concurrent calls of the same key.
+           key is None if the call can't be shared.
+        '''
+        if key is None or not biothing_settings.es_coalesce_requests:
+            return fn(*args)
+        return self._single_flight.do(key, lambda: fn(*args))
+
+    @gen.coroutine
+    def get_biothing(self, bid, **kwargs):
+        '''unknown vid return None'''
+        options = self._get_cleaned_annotation_options(kwargs)
+        try:
+            options_key = json.dumps(options, sort_keys=True, default=str)
+            key = json.dumps(['get', bid, options_key])
+        except TypeError:
+            options_key = key = None
+        res = yield self._coalesce(key, self._get_biothing, bid, options, options_key)
+        return res
+
+    @gen.coroutine
+    def _get_biothing(self, bid, options, options_key=None):
+        passthrough = self._use_passthrough(options)
+        if self._get_batcher and options_key is not None and not passthrough:
+            res = yield self._get_batcher.get(bid, options, options_key)
+            return res
+        try:
+            if passthrough:
+                res = yield self._get_raw(bid, options)
+            else:
+                res = yield self._async_es.get(index=self._index, id=bid, doc_type=self._doc_type, **self._get_biothing_kwargs(options))
+        except NotFoundError:
+            return
+
+        return self._cleaned_get_res(res, options)
+
+    @gen.coroutine
+    def exists(self, bid):
+        """return True/False if a biothing id exists or not."""
+        try:
+            doc = yield self.get_biothing(bid, fields=None)
+            return doc['found']
+        except NotFoundError:
+            return False
+
+    @gen.coroutine
+    def _msearch(self, **kwargs):
+        res = yield self._async_es.msearch(**kwargs)
+        return res['responses']
+
+    @gen.coroutine
+    def _mget(self, **kwargs):
+        res = yield self._async_es.mget(**kwargs)
+        return res['docs']
+
+    @gen.coroutine
+    def mget_biothings(self, bid_list, **kwargs):
+        '''for /query post request'''
+        options = self._get_cleaned_annotation_options(kwargs)
+        unique_bids, idx = unique_ids(bid_list)
+        if self._is_id_scope(options):
+            body = self._build_mget_body(unique_bids)
+            if options.rawquery:
+                return json.dumps(body)
+            res = yield self._mget(body=body, index=self._index, doc_type=self._doc_type, **self._get_biothing_kwargs(options))
+            return self._cleaned_mget_docs(res, bid_list, idx, options)
+
+        try:
+            if self._use_terms_query(options):
+                res = yield self._terms_mget(unique_bids, options)
+                return self._cleaned_mget_res(res, bid_list, idx, options)
+            _q = self._build_mget_query(unique_bids, options)
+        except QueryError as err:
+            return {'success': False,
+                    'error': str(err)}
+        if options.rawquery:
+            return _q
+        res = yield self._msearch(body=_q, index=self._index, doc_type=self._doc_type)
+        return self._cleaned_mget_res(res, bid_list, idx, options)
+
+    @gen.coroutine
+    def _terms_mget(self, bid_list, options):
+        chunks, _q = self._build_terms_query(bid_list, options)
+        res = yield self._msearch(body=_q, index=self._index, doc_type=self._doc_type)
+        responses, fallback = self._split_terms_res(chunks, res, options)
+        if fallback:
+            res = yield self._msearch(body=self._build_mget_query(fallback, options), index=self._index, doc_type=self._doc_type)
+            responses = self._merge_fallback_res(responses, res)
+        return responses
+
+    def _search(self, q, scroll_options={}, **kwargs):
+        kwargs.update(scroll_options)
+        return self._async_es.search(index=self._index, doc_type=self._doc_type, body=q, **kwargs)
+
+    @gen.coroutine
+    def _raw_request(self, method, path, params=None, body=None):
+        res = yield self._async_es.perform_request(method, path, params=params, body=body, decode=False)
+        return RawJSON(res)
+
+    @gen.coroutine
+    def query(self, q, client=None, **kwargs):
+        try:
+            q, options, _query, scroll_options = self._get_query_args(q, kwargs)
+            cache_key = self._query_cache_key(_query, options)
+            res = self._query_cache.get(cache_key) if cache_key else None
+            if res is not None:
+                return res
+            if options.fetch_all:
+                self._scrolls.check(client)
+            # each fetch_all query opens its own scroll
+            key = None if options.fetch_all else json.dumps(['query', _query, options], sort_keys=True, default=str)
+            res = yield self._coalesce(key, self._query, _query, scroll_options, options, cache_key, client)
+        except Exception as e:
+            return self._query_error(q, e)
+        return res
+
+    @gen.coroutine
+    def _query(self, _query, scroll_options, options, cache_key, client=None):
+        if self._use_raw_search(options):
+            res = yield self._search_raw(_query, **dict(options.kwargs))
+        else:
+            res = yield self._search(_query, scroll_options=scroll_options, **options.kwargs)
+        if options.fetch_all:
+            self._scrolls.open(res, client)
+        res = self._cleaned_query_res(res, options)
+        if cache_key:
+            self._query_cache.set(cache_key, res)
+        return res
+
+    @gen.coroutine
+    def scroll(self, scroll_id, client=None, **kwargs):
+        '''return the results from a scroll ID, recognizes options.raw'''
+        options = self._get_cleaned_query_options(kwargs)
+        if self._scrolls.is_exhausted(scroll_id):
+            return {'success': False, 'error': 'No results to return.'}
+        r = yield self._scrolls.take_prefetch(scroll_id) or self._scroll(scroll_id)
+        self._scrolls.advance(scroll_id, r, client)
+        return self._cleaned_scroll_res(r, options)
+
+    def _scroll(self, scroll_id):
+        return self._async_es.scroll(scroll_id, scroll=self._scroll_time)
+
+    def _clear_scroll(self, scroll_id):
+        return self._async_es.clear_scroll(scroll_id)
+
+    def _prefetch_scroll(self, scroll_id):
+        future = self._scroll(scroll_id)
+        # an error is raised again when the batch is taken, don't log it if it never is
+        future.add_done_callback(lambda f: f.exception())
+        return future
+
+    @gen.coroutine
+    def _discard_scroll(self, scroll_id):
+        try:
+            yield self._clear_scroll(scroll_id)
+        except Exception as e:
+            logging.debug("Can't clear scroll: %s" % e)
+
+    @gen.coroutine
+    def status_check(self, bid):
+        r = yield self.get_biothing(bid)
+        return r
+
+    @gen.coroutine
+    def _check_health(self, deep=False):
+        try:
+            if deep:
+                doc = yield self.status_check(biothing_settings.status_check_id)
+                doc_exists = doc is not None
+            else:
+                doc_exists = yield self._async_es.exists(index=self._index, doc_type=self._doc_type, id=biothing_settings.status_check_id)
+        except Exception as e:
+            return self._cleaned_health(False, None, error=str(e))
+        try:
+            res = yield self._async_es.cluster_health(index=self._index)
+            cluster_status = res['status']
+        except Exception as e:
+            return self._cleaned_health(doc_exists, 'unknown', error=str(e))
+        return self._cleaned_health(doc_exists, cluster_status)
+
+    @gen.coroutine
+    def _refresh_health(self):
+        if self._health_checking:
+            return
+        self._health_checking = True
+        try:
+            yield self._check_health()
+        finally:
+            self._health_checking = False
+
+    @gen.coroutine
+    def get_health(self, deep=False):
+        health = yield gen.maybe_future(super(AsyncESQuery, self).get_health(deep=deep))
+        return health
+
+    def get_metrics(self):
+        metrics = super(AsyncESQuery, self).get_metrics()
+        metrics['coalesced_requests'] = self._single_flight.stats
+        if self._get_batcher:
+            metrics['batched_gets'] = self._get_batcher.stats
+        return metrics
+
+    def reconnect(self):
+        super(AsyncESQuery, self).reconnect()
+        self._async_es = get_async_es(biothing_settings.es_host, max_clients=biothing_settings.es_max_clients)
+
 
 class ESQueryBuilder(object):
+    # pre-rendered msearch lines of build_id_query, per (scopes, query options)
+    _id_query_templates = LRUCache(max_entries=1000)
+    _id_placeholder = '__biothings_id_placeholder__'
+
     def __init__(self, **query_options):
         self._query_options = query_options
 
@@ -416,13 +1634,69 @@ class ESQueryBuilder(object):
         _q.update(self._query_options)
         return _q
 
+    def has_default_id_query(self):
+        '''False if a subclass overrides build_id_query.'''
+        return type(self).build_id_query is ESQueryBuilder.build_id_query
+
+    def get_id_query_template(self, scopes=None):
+        '''return (prefix, suffix) such that prefix + json.dumps("{}".format(bid)) + suffix
+           are the msearch lines (header and query) of build_id_query(bid, scopes).
+           return None if build_id_query is overridden, its output may then depend on bid.
+        '''
+        if not self.has_default_id_query():
+            return None
+        try:
+            key = (json.dumps(scopes), json.dumps(self._query_options, sort_keys=True))
+        except TypeError:
+            return None
+        template = self._id_query_templates.get(key)
+        if template is None:
+            _line = json.dumps(self.build_id_query(self._id_placeholder, scopes))
+            _parts = _line.split(json.dumps(self._id_placeholder))
+            # False if the placeholder also shows up in the query options
+            template = len(_parts) == 2 and ('{}\n' + _parts[0], _parts[1] + '\n')
+            self._id_query_templates.set(key, template)
+        return template or None
+
     def build_multiple_id_query(self, bid_list, scopes=None):
         """make a query body for msearch query."""
+        template = self.get_id_query_template(scopes)
+        if template:
+            prefix, suffix = template
+            return ''.join([prefix + json.dumps("{}".format(id)) + suffix for id in bid_list])
         _q = []
         for id in bid_list:
             _q.extend(['{}', json.dumps(self.build_id_query(id, scopes))])
         _q.append('')
         return '\n'.join(_q)
+
+    def build_terms_query(self, terms, scopes, size=None):
+        '''a query matching any of terms exactly on any of the scopes fields.
+           scopes fields are returned as fielddata_fields so that hits can be mapped
+           back to their terms.
+        '''
+        scopes = [scopes] if is_str(scopes) else scopes
+        terms = ["{}".format(term) for term in terms]
+        _query = {
+            "bool": {
+                "should": [{"terms": {field: terms}} for field in scopes]
+            }
+        }
+        _q = {"query": _query}
+        self._query_options.pop("query", None)    # avoid "query" be overwritten by self.query_options
+        _q.update(self._query_options)
+        _q["fielddata_fields"] = scopes
+        if size:
+            _q["size"] = size
+        return _q
+
+    def build_multiple_terms_query(self, terms_list, scopes, size=None):
+        """make a msearch query body with one terms query for each list of terms."""
+        _q = []
+        for terms in terms_list:
+            _q.extend(['{}', json.dumps(self.build_terms_query(terms, scopes, size))])
+        _q.append('')
+        return '\n'.join(_q)
         
     def default_query(self, q):
         return {
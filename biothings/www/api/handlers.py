@@ -1,11 +1,11 @@
 import re
 import json
+from tornado import gen
 from tornado.web import HTTPError
-from biothings.www.helper import BaseHandler
+from biothings.www.helper import BaseHandler, json_encode, compressed_body_cache
 from biothings.utils.common import split_ids
-from biothings.utils.version import get_python_version
-from biothings.utils.version import get_repository_information
-from biothings.utils.version import get_biothings_commit
+from biothings.utils.version import get_software_info
+from biothings.utils.ga import ga_queue
 from biothings.settings import BiothingSettings
 
 biothing_settings = BiothingSettings()
@@ -26,13 +26,14 @@ class BiothingHandler(BaseHandler):
             pass
         pass
 
+    @gen.coroutine
     def get(self, bid=None):
         '''
         '''
         if bid:
             kwargs = self.get_query_params()
             self._examine_kwargs('GET', kwargs)
-            biothing_object = self.esq.get_biothing(bid, **kwargs)
+            biothing_object = yield gen.maybe_future(self.esq.get_biothing(bid, **kwargs))
             if biothing_object:
                 self.return_json(biothing_object)
                 self.ga_track(event=self._ga_event_object('GET'))
@@ -41,6 +42,7 @@ class BiothingHandler(BaseHandler):
         else:
             raise HTTPError(404)
 
+    @gen.coroutine
     def post(self, ids=None):
         '''
            This is essentially the same as post request in QueryHandler, with different defaults.
@@ -50,13 +52,20 @@ class BiothingHandler(BaseHandler):
             fields
             email
             jsonld
+            format      if "ndjson", results are streamed as newline delimited JSON,
+                        if "tsv", "csv" or "arrow", as the rows of a table (see get_table_writer).
         '''
         kwargs = self.get_query_params()
         self._examine_kwargs('POST', kwargs)
         ids = kwargs.pop('ids', None)
         if ids:
             ids = re.split('[\s\r\n+|,]+', ids)
-            res = self.esq.mget_biothings(ids, **kwargs)
+            writer = self.get_table_writer()
+            if writer or self.use_ndjson(kwargs):
+                yield self.return_ndjson_stream(ids, writer=writer, **kwargs)
+                self.ga_track(event=self._ga_event_object('POST', {'qsize': len(ids)}))
+                return
+            res = yield gen.maybe_future(self.esq.mget_biothings(ids, **kwargs))
         else:
             res = {'success': False, 'error': "Missing required parameters."}
         encode = not isinstance(res, str)    # when res is a string, e.g. when rawquery is true, do not encode it as json
@@ -79,6 +88,7 @@ class QueryHandler(BaseHandler):
             pass
         pass
 
+    @gen.coroutine
     def get(self):
         '''
         parameters:
@@ -90,7 +100,11 @@ class QueryHandler(BaseHandler):
             facets
             callback
             email
-            fetch_all
+            fetch_all   with format=ndjson, all the hits are streamed as newline delimited JSON,
+                        with format=tsv, csv or arrow, as the rows of a table.
+            format      ndjson, or tsv, csv or arrow for tabular results (with fields).
+            cursor      "true" for the first page of cursor pagination, then the "next" value
+                        of the previous page.  Needs Elasticsearch 5.0 or later.
             jsonld
             explain
             raw
@@ -99,9 +113,10 @@ class QueryHandler(BaseHandler):
         self._examine_kwargs('GET', kwargs)
         q = kwargs.pop('q', None)
         scroll_id = kwargs.pop('scroll_id', None)
+        kwargs['client'] = self.request.remote_ip    # caps the open scrolls per client, see the xheaders option
         _has_error = False
         if scroll_id:
-            res = self.esq.scroll(scroll_id, **kwargs)
+            res = yield gen.maybe_future(self.esq.scroll(scroll_id, **kwargs))
         elif q:
             for arg in ['from', 'size']:
                 value = kwargs.get(arg, None)
@@ -111,8 +126,18 @@ class QueryHandler(BaseHandler):
                     except ValueError:
                         res = {'success': False, 'error': 'Parameter "{}" must be an integer.'.format(arg)}
                         _has_error = True
-            if not _has_error:
-                res = self.esq.query(q, **kwargs)
+            writer = None if _has_error else self.get_table_writer()
+            if not _has_error and kwargs.get('fetch_all', False) and (writer or self.use_ndjson(kwargs)):
+                # server-side export of all the hits
+                export = self.esq.export(q, **kwargs)
+                if isinstance(export, dict):
+                    res = export
+                else:
+                    yield self.return_export_stream(export, writer=writer)
+                    self.ga_track(event=self._ga_event_object('fetch_all', {'total': export.total}))
+                    return
+            elif not _has_error:
+                res = yield gen.maybe_future(self.esq.query(q, **kwargs))
                 if kwargs.get('fetch_all', False):
                     self.ga_track(event=self._ga_event_object('fetch_all', {'total': res.get('total', None)}))
         else:
@@ -121,6 +146,7 @@ class QueryHandler(BaseHandler):
         self.return_json(res)
         self.ga_track(event=self._ga_event_object('GET', {'qsize': len(q) if q else 0}))
 
+    @gen.coroutine
     def post(self):
         '''
         parameters:
@@ -130,6 +156,8 @@ class QueryHandler(BaseHandler):
             email
             jsonld
             jsoninput   if true, input "q" is a json string, must be decoded as a list.
+            format      if "ndjson", results are streamed as newline delimited JSON,
+                        if "tsv", "csv" or "arrow", as the rows of a table (see get_table_writer).
         '''
         kwargs = self.get_query_params()
         self._examine_kwargs('POST', kwargs)
@@ -147,7 +175,12 @@ class QueryHandler(BaseHandler):
             if ids:
                 scopes = kwargs.pop('scopes', None)
                 fields = kwargs.pop('fields', None)
-                res = self.esq.mget_biothings(ids, fields=fields, scopes=scopes, **kwargs)
+                writer = self.get_table_writer()
+                if writer or self.use_ndjson(kwargs):
+                    yield self.return_ndjson_stream(ids, writer=writer, fields=fields, scopes=scopes, **kwargs)
+                    self.ga_track(event=self._ga_event_object('POST', {'qsize': len(q)}))
+                    return
+                res = yield gen.maybe_future(self.esq.mget_biothings(ids, fields=fields, scopes=scopes, **kwargs))
         else:
             res = {'success': False, 'error': "Missing required parameters."}
 
@@ -158,6 +191,7 @@ class QueryHandler(BaseHandler):
 
 class Neo4jQueryHandler(BaseHandler):
     ''' Implements a graph query endpoint for HTML GET. '''
+    index_etag = False
 
     def _ga_event_object(self, action, data={}):
         ''' Returns the google analytics object for requests on this endpoint (query handler).'''
@@ -185,63 +219,72 @@ class MetaDataHandler(BaseHandler):
     
     def get(self):
         _meta = self.esq.get_mapping_meta()
-        _meta['software'] = {
-            'python-package-info': get_python_version(),
-            'codebase': get_repository_information(),
-            'biothings': get_biothings_commit()
-        }
+        _meta['software'] = get_software_info()
         self.return_json(_meta)
 
 
-class FieldsHandler(BaseHandler):
+class MetricsHandler(BaseHandler):
+    ''' Returns runtime counters (caches, etc.) of this process. '''
+    disable_caching = True
 
     def get(self):
-        es_mapping = self.esq.query_fields()
-        if biothing_settings.field_notes_path:
-            notes = json.load(open(biothing_settings.field_notes_path, 'r'))
-        else:
-            notes = {}
-        kwargs = self.get_query_params()
+        metrics = self.esq.get_metrics()
+        metrics['ga'] = ga_queue.stats
+        metrics['compressed_body_cache'] = compressed_body_cache.stats
+        self.return_json(metrics)
 
-        def get_indexed_properties_in_dict(d, prefix):
-            r = {}
-            for (k, v) in d.items():
-                r[prefix + '.' + k] = {}
-                r[prefix + '.' + k]['indexed'] = False
-                if 'properties' not in v:
-                    r[prefix + '.' + k]['type'] = v['type']
-                    if ('index' not in v) or ('index' in v and v['index'] != 'no'):
-                        # indexed field
-                        r[prefix + '.' + k]['indexed'] = True
-                else:
-                    r[prefix + '.' + k]['type'] = 'object'
-                    r.update(get_indexed_properties_in_dict(v['properties'], prefix + '.' + k))
-                if ('include_in_all' in v) and v['include_in_all']:
-                    r[prefix + '.' + k]['include_in_all'] = True
-                else:
-                    r[prefix + '.' + k]['include_in_all'] = False
-            return r
 
-        r = {}
+class JsonLdContextHandler(BaseHandler):
+    ''' Serves the JSON-LD contexts referenced by jsonld responses, when
+        JSONLD_CONTEXT_BY_REFERENCE is True. '''
+
+    def get(self, context_key):
+        context = self.esq.get_jsonld_context(context_key)
+        if context is None:
+            raise HTTPError(404)
+        self.return_json(context)
+        self.set_header("Content-Type", "application/ld+json; charset=UTF-8")
+
+
+class FieldsHandler(BaseHandler):
+
+    def get(self):
+        kwargs = self.get_query_params()
         search = kwargs.pop('search', None)
         prefix = kwargs.pop('prefix', None)
-        for (k, v) in get_indexed_properties_in_dict(es_mapping, '').items():
-            k1 = k.lstrip('.')
-            if (search and search in k1) or (prefix and k1.startswith(prefix)) or (not search and not prefix):
-                r[k1] = v
-                if k1 in notes:
-                    r[k1]['notes'] = notes[k1]
-        self.return_json(r)
+        catalog = self.esq.get_field_catalog()
+        if search or prefix:
+            self.return_json(catalog.find(search=search, prefix=prefix))
+        elif self.get_argument('msgpack', ''):
+            self.return_json(catalog.fields)
+        else:
+            # all the fields, encoded once per mapping
+            self.return_json(catalog.to_json(json_encode, indent=self.get_json_indent()), encode=False)
 
 class StatusHandler(BaseHandler):
-    ''' Handles requests to check the status of the server. '''
+    ''' Handles requests to check the status of the server.
+        Answers from the last background health check (see ESQuery.get_health), or from
+        a live check through ESQuery.status_check with "deep=1".  Unhealthy is a 503, ok and
+        degraded are 200s, told apart by the X-Health-Status header and the body of GET. '''
+    status_codes = {'ok': 200, 'degraded': 200, 'unhealthy': 503}
+    index_etag = False
+
+    @gen.coroutine
+    def _get_health(self):
+        deep = self.get_argument('deep', '').lower() in ['1', 'true']
+        health = yield gen.maybe_future(self.esq.get_health(deep=deep))
+        if health['status'] == 'unhealthy':
+            # we failed to retrieve ref/test doc, something is wrong -> service unavailable
+            raise HTTPError(self.status_codes['unhealthy'])
+        self.set_status(self.status_codes[health['status']])
+        self.set_header('X-Health-Status', health['status'])
+        return health
 
+    @gen.coroutine
     def head(self):
-        r = self.esq.status_check(biothing_settings.status_check_id)
-        if r is None:
-            # we failed to retrieve ref/test doc, something is wrong -> service unavailable
-            raise HTTPError(503)
+        yield self._get_health()
 
+    @gen.coroutine
     def get(self):
-        self.head()
-        self.write('OK')
+        health = yield self._get_health()
+        self.write('OK' if health['status'] == 'ok' else health['status'].upper())
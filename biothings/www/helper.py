@@ -1,7 +1,17 @@
-import json
+import gzip
+import zlib
+import hashlib
 import datetime
 import tornado.web
+from tornado import gen
 from biothings.utils.ga import GAMixIn
+from biothings.utils.common import is_str, get_accepted_encodings
+# DateTimeJSONEncoder moved to biothings.utils.jsonenc, still importable from here
+from biothings.utils.jsonenc import get_json_encoder, RawJSON, DateTimeJSONEncoder
+from biothings.utils.tabular import TABLE_WRITERS, TABULAR_FORMATS
+from biothings.utils.cache import LRUCache
+from biothings.utils.version import get_repository_information
+from biothings import get_version
 from biothings.settings import BiothingSettings
 from importlib import import_module
 
@@ -14,6 +24,11 @@ if SUPPORT_MSGPACK:
             return {'__datetime__': True, 'as_str': obj.strftime("%Y%m%dT%H:%M:%S.%f")}
         return obj
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 # TODO: Modify this to take 1 backend... i.e. a self.backend rather than
 # a self.esq for es queries and a self.neo4jq for neo4j queries
 biothing_settings = BiothingSettings()
@@ -21,12 +36,55 @@ es_biothings = import_module(biothing_settings.es_query_module)
 if biothing_settings.is_neo4j_app:
     neo4j_biothings = import_module(biothing_settings.neo4j_query_module)
 
-class DateTimeJSONEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, datetime.datetime):
-            return obj.isoformat()
+# compressed bodies of cacheable GET responses, see BaseHandler.write_compressed
+compressed_body_cache = LRUCache(max_entries=biothing_settings.compression_cache_max_entries,
+                                 max_bytes=biothing_settings.compression_cache_max_bytes,
+                                 sizeof=lambda v: len(v[2]))
+
+_etag_version = None
+
+
+def get_etag_version():
+    '''the version of the code and configuration serving the responses, part of their
+       ETags, see BaseHandler.get_index_etag.  Collected on first use.
+    '''
+    global _etag_version
+    if _etag_version is None:
+        _etag_version = [get_version(), get_repository_information()['commit-hash'],
+                         biothing_settings.etag_version]
+    return _etag_version
+
+def compress_body(data, encoding):
+    '''compress data (bytes) with encoding, "gzip" or "zstd".'''
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=biothing_settings.zstd_compression_level).compress(data)
+    return gzip.compress(data, compresslevel=biothing_settings.gzip_compression_level)
+
+class StreamCompressor(object):
+    '''compress a streamed body with encoding, "gzip" or "zstd", chunk by chunk: each
+       compressed chunk can be decompressed as soon as it's received.
+    '''
+    def __init__(self, encoding):
+        if encoding == 'zstd':
+            self._compressor = zstandard.ZstdCompressor(level=biothing_settings.zstd_compression_level).compressobj()
+            self._flush_mode = zstandard.COMPRESSOBJ_FLUSH_BLOCK
         else:
-            return super(DateTimeJSONEncoder, self).default(obj)
+            self._compressor = zlib.compressobj(biothing_settings.gzip_compression_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            self._flush_mode = zlib.Z_SYNC_FLUSH
+
+    def compress(self, data):
+        return self._compressor.compress(data) + self._compressor.flush(self._flush_mode)
+
+    def close(self):
+        return self._compressor.flush()
+
+_json_encode = get_json_encoder(biothing_settings.json_encoder, sort_keys=biothing_settings.sort_keys)
+
+def json_encode(data, indent=None):
+    '''encode data as JSON, with the JSON_ENCODER backend.  Doc keys are sorted here
+       (unless SORT_KEYS is False) rather than when hits are post-processed.
+    '''
+    return _json_encode(data, indent=indent)
 
 
 class BaseHandler(tornado.web.RequestHandler, GAMixIn):
@@ -34,7 +92,9 @@ class BaseHandler(tornado.web.RequestHandler, GAMixIn):
     cache_max_age = 604800  # 7days
     disable_caching = False
     boolean_parameters = set(['raw', 'rawquery', 'fetch_all', 'explain', 'jsonld','dotfield'])
-    esq = es_biothings.ESQuery()
+    index_etag = True   # GET responses only depend on the request and the ES index, see get_index_etag
+    no_etag_parameters = set(['scroll_id', 'fetch_all'])    # the same request returns new scroll ids
+    esq = es_biothings.AsyncESQuery() if biothing_settings.es_async else es_biothings.ESQuery()
     if biothing_settings.is_neo4j_app:
         neo4jq = neo4j_biothings.Neo4jQuery()
 
@@ -96,12 +156,49 @@ class BaseHandler(tornado.web.RequestHandler, GAMixIn):
         _args['host'] = self.request.host     # Store the host URL that this request is being served from
         if SUPPORT_MSGPACK:
             _args.pop('msgpack', None)
+        _args.pop('format', None)   # output format, see use_ndjson and get_table_writer
+        _args.pop('pretty', None)   # see get_json_indent
         self._check_fields_param(_args)
         self._check_paging_param(_args)
         self._check_boolean_param(_args)
         self._check_facets_param(_args)
         return _args
 
+    def get_index_etag(self):
+        '''the ETag of this GET request, from the index version (see ESQuery.get_index_version),
+           the code version (see get_etag_version) and the normalized request (path, sorted
+           arguments and Accept header), so it changes only when the index is rebuilt or the
+           server updated.  Weak, as the body may be compressed differently.  None if the
+           response isn't derived from the index only.
+        '''
+        if not self.index_etag or self.disable_caching or self.request.method not in ('GET', 'HEAD'):
+            return None
+        args = self.request.query_arguments
+        if self.no_etag_parameters.intersection(args):
+            return None
+        key = repr([self.esq.get_index_version(), get_etag_version(), self.request.path, self.request.headers.get('Accept', ''),
+                    [(k, args[k]) for k in sorted(args)]])
+        return 'W/"{}"'.format(hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def prepare(self):
+        '''answer 304 Not Modified before querying ES, when If-None-Match has the ETag of this request.'''
+        self._index_etag = self.get_index_etag()
+        if self._index_etag and self.request.headers.get('If-None-Match'):
+            # check_etag_header compares with the Etag header
+            self.set_header('Etag', self._index_etag)
+            if self.check_etag_header():
+                self.set_cacheable()
+                self.support_cors()
+                self.set_status(304)
+                self.finish()
+            else:
+                # set by finish from compute_etag, once it's known the response isn't an error
+                self.clear_header('Etag')
+
+    def compute_etag(self):
+        '''the index ETag of this request if any, else the hash of the body (tornado's default).'''
+        return getattr(self, '_index_etag', None) or super(BaseHandler, self).compute_etag()
+
     # def get_current_user(self):
     #     user_json = self.get_secure_cookie("user")
     #     if not user_json:
@@ -112,28 +209,209 @@ class BaseHandler(tornado.web.RequestHandler, GAMixIn):
         '''return passed data object as JSON response.
            if <jsonp_parameter> is passed, return a valid JSONP response.
            if encode is False, assumes input data is already a JSON encoded
-           string.
+           string.  RawJSON data (e.g. a passed through ES response) is not
+           encoded again, unless pretty printed or returned as msgpack.
+           Docs and query results are returned as a table with format=tsv, csv or arrow.
         '''    
-        # call the recursive function to sort the data by keys and add the json-ld information
-        indent = indent or 2   # tmp settings
+        if encode and not isinstance(data, RawJSON) and self.get_argument('format', '') in TABULAR_FORMATS and \
+           (isinstance(data, list) or (isinstance(data, dict) and ('_id' in data or isinstance(data.get('hits'), list)))):
+            # docs or query results, see get_table_writer
+            writer = self.get_table_writer()
+            if writer:
+                self.return_table(data, writer)
+                return
+        indent = indent or self.get_json_indent()
         jsoncallback = self.get_argument(self.jsonp_parameter, '')  # return as JSONP
-        if SUPPORT_MSGPACK:
-            use_msgpack = self.get_argument('msgpack', '')
-        if SUPPORT_MSGPACK and use_msgpack:
+        use_msgpack = SUPPORT_MSGPACK and self.get_argument('msgpack', '')
+        if isinstance(data, dict) and data.get('success') is False:
+            # an error, not to be cached until the index is rebuilt
+            self._index_etag = None
+        if isinstance(data, RawJSON):
+            if indent or use_msgpack:
+                data = data.load()
+            else:
+                encode = False
+        if use_msgpack:
             _json_data = msgpack.packb(data, use_bin_type=True, default=msgpack_encode_datetime)
             self.set_header("Content-Type", "application/x-msgpack")
         else:
-            _json_data = json.dumps(data, cls=DateTimeJSONEncoder, indent=indent) if encode else data
+            _json_data = json_encode(data, indent=indent) if encode else data
             self.set_header("Content-Type", "application/json; charset=UTF-8")
         if not self.disable_caching:
-            #get etag if data is a dictionary and has "etag" attribute.
+            #get etag if data is a dictionary and has "etag" attribute, see compute_etag otherwise.
             etag = data.get('etag', None) if isinstance(data, dict) else None
             self.set_cacheable(etag=etag)
         self.support_cors()
         if jsoncallback:
-            self.write('%s(%s)' % (jsoncallback, _json_data))
+            self.write_compressed('%s(%s)' % (jsoncallback, _json_data))
         else:
-            self.write(_json_data)
+            self.write_compressed(_json_data)
+
+    def get_table_writer(self):
+        '''the TableWriter of the tabular format asked with "format" (see TABULAR_FORMATS), or None.
+           Its columns are the requested "fields", after "query" for POST requests and "_id".
+           None with raw or rawquery.
+        '''
+        fmt = self.get_argument('format', '')
+        if fmt not in TABULAR_FORMATS:
+            return None
+        if fmt not in TABLE_WRITERS:
+            raise tornado.web.HTTPError(400, reason='Format "{}" is not available.'.format(fmt))
+        kwargs = self.get_query_params()
+        if kwargs.get('raw') or kwargs.get('rawquery'):
+            # ES responses or queries, not docs
+            return None
+        fields = kwargs.get('fields')
+        if is_str(fields):
+            fields = [f.strip() for f in fields.split(',')]
+        fields = [f for f in fields or [] if f and f != '_id']
+        if not fields or fields == ['all']:
+            raise tornado.web.HTTPError(400, reason='Parameter "fields" is required for format "{}".'.format(fmt))
+        columns = (['query'] if self.request.method == 'POST' else []) + ['_id'] + fields
+        return TABLE_WRITERS[fmt](columns)
+
+    def return_table(self, data, writer):
+        '''return data, a doc, a list of docs or query results, as a table written by writer.'''
+        if isinstance(data, dict):
+            data = data['hits'] if '_id' not in data else [data]
+        self.set_header("Content-Type", writer.content_type)
+        if not self.disable_caching:
+            self.set_cacheable()
+        self.support_cors()
+        self.write_compressed(writer.header() + writer.rows(data) + writer.close())
+
+    def get_compression(self):
+        '''the content coding negotiated from Accept-Encoding, in COMPRESSION_ENCODINGS order
+           (zstd only if the zstandard module is installed), or None.
+        '''
+        accepted = get_accepted_encodings(self.request.headers.get('Accept-Encoding', ''))
+        for encoding in biothing_settings.compression_encodings:
+            if encoding == 'zstd' and not zstandard:
+                continue
+            if encoding in accepted:
+                return encoding
+
+    def write_compressed(self, body):
+        '''write the whole response body, compressed with the negotiated content coding if
+           larger than COMPRESSION_MIN_SIZE.  The compressed bodies of cacheable GET responses
+           are kept in compressed_body_cache, a repeated response is not compressed again.
+        '''
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        self.set_header('Vary', 'Accept-Encoding')
+        encoding = self.get_compression() if len(body) >= biothing_settings.compression_min_size else None
+        if encoding is None:
+            self.write(body)
+            return
+        compressed = cache_key = None
+        if self.request.method == 'GET' and not self.disable_caching:
+            # cached by URL, but only served for the very same body
+            cache_key = (self.request.uri, encoding)
+            fingerprint = (len(body), hash(body))
+            cached = compressed_body_cache.get(cache_key)
+            if cached and cached[:2] == fingerprint:
+                compressed = cached[2]
+        if compressed is None:
+            compressed = compress_body(body, encoding)
+            if cache_key:
+                compressed_body_cache.set(cache_key, fingerprint + (compressed,))
+        self.set_header('Content-Encoding', encoding)
+        self.write(compressed)
+
+    def start_stream(self):
+        '''start a streamed response body, written with write_stream then end_stream,
+           compressed with the negotiated content coding.
+        '''
+        self.set_header('Vary', 'Accept-Encoding')
+        encoding = self.get_compression()
+        self._stream_compressor = StreamCompressor(encoding) if encoding else None
+        if encoding:
+            self.set_header('Content-Encoding', encoding)
+
+    def write_stream(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        if self._stream_compressor:
+            data = self._stream_compressor.compress(data)
+        self.write(data)
+
+    def end_stream(self):
+        if self._stream_compressor:
+            self.write(self._stream_compressor.close())
+
+    def get_json_indent(self):
+        '''JSON responses are compact, unless pretty printing was asked with "pretty=1".'''
+        return 2 if self.get_argument('pretty', '').lower() in ['1', 'true'] else None
+
+    def use_ndjson(self, kwargs={}):
+        '''True if the client asked for a newline delimited JSON stream
+           (format=ndjson or "Accept: application/x-ndjson").
+        '''
+        if kwargs.get('rawquery'):
+            return False
+        return self.get_argument('format', '') == 'ndjson' or \
+               'application/x-ndjson' in self.request.headers.get('Accept', '')
+
+    @gen.coroutine
+    def return_ndjson_stream(self, ids, writer=None, **kwargs):
+        '''query ids in chunks of NDJSON_CHUNK_SIZE, writing the results of each chunk
+           as newline delimited JSON (one line per result) as soon as it's returned,
+           or as the rows of a table if writer (see get_table_writer) is given.
+           The next chunk is queried while the previous one is sent.
+        '''
+        self.set_header("Content-Type", writer.content_type if writer else "application/x-ndjson; charset=UTF-8")
+        self.support_cors()
+        self.start_stream()
+        if writer:
+            self.write_stream(writer.header())
+        size = biothing_settings.ndjson_chunk_size
+        chunks = [ids[i:i + size] for i in range(0, len(ids), size)]
+        pending = gen.maybe_future(self.esq.mget_biothings(chunks[0], **dict(kwargs)))
+        for i in range(len(chunks)):
+            res = yield pending
+            if isinstance(res, dict):
+                # an error, ends the stream (a table just ends)
+                if not writer:
+                    self.write_stream(json_encode(res) + '\n')
+                break
+            if writer:
+                self.write_stream(writer.rows(res))
+            else:
+                self.write_stream(''.join([json_encode(r) + '\n' for r in res]))
+            flushed = self.flush()
+            if i + 1 < len(chunks):
+                pending = gen.maybe_future(self.esq.mget_biothings(chunks[i + 1], **dict(kwargs)))
+            yield flushed
+        if writer:
+            self.write_stream(writer.close())
+        self.end_stream()
+
+    @gen.coroutine
+    def return_export_stream(self, export, writer=None):
+        '''write all the hits of export (a ScrollExport) as newline delimited JSON,
+           or as the rows of a table if writer (see get_table_writer) is given,
+           batch by batch, compressed with the negotiated content coding.
+        '''
+        self.set_header("Content-Type", writer.content_type if writer else "application/x-ndjson; charset=UTF-8")
+        self.support_cors()
+        self.start_stream()
+        try:
+            if writer:
+                self.write_stream(writer.header())
+            while True:
+                hits = yield gen.maybe_future(export.next())
+                if hits is None:
+                    break
+                if writer:
+                    self.write_stream(writer.rows(hits))
+                else:
+                    self.write_stream(''.join([json_encode(hit) + '\n' for hit in hits]))
+                yield self.flush()
+        finally:
+            export.close()
+        if writer:
+            self.write_stream(writer.close())
+        self.end_stream()
 
     def set_cacheable(self, etag=None):
         '''set proper header to make the response cacheable.
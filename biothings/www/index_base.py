@@ -7,14 +7,19 @@ Currently available URLs:
     /v1/variant/<variant_id>    variant annotation service
 
 '''
-#import sys
+import sys
 import os.path
+import time
+import signal
+import logging
 #import subprocess
 #import json
 
 import tornado.httpserver
 import tornado.ioloop
+import tornado.netutil
 import tornado.options
+import tornado.process
 import tornado.web
 import tornado.escape
 from tornado.options import define, options
@@ -27,10 +32,15 @@ __USE_WSGI__ = False
 define("port", default=8000, help="run on the given port", type=int)
 define("address", default="127.0.0.1", help="run on localhost")
 define("debug", default=False, type=bool, help="run in debug mode")
+define("processes", default=0, type=int, help="number of server processes, 0 for one per CPU core (1 in debug mode)")
+define("drain_timeout", default=30, type=int, help="seconds given to the requests in flight on SIGTERM")
+define("reuse_port", default=False, type=bool,
+       help="bind with SO_REUSEPORT, a new server can then start before the old one gets SIGTERM")
+define("xheaders", default=False, type=bool,
+       help="take the client IP from the X-Real-Ip/X-Forwarded-For headers, only behind a trusted proxy setting them")
 tornado.options.parse_command_line()
 if options.debug:
     import tornado.autoreload
-    import logging
     logging.getLogger().setLevel(logging.DEBUG)
     options.address = '0.0.0.0'
 
@@ -43,14 +53,116 @@ if options.debug:
     # from config import auth_settings
     # settings.update(auth_settings)
 
+class Application(tornado.web.Application):
+    ''' Counts the requests in flight, drained on SIGTERM (see shutdown). '''
+    def __init__(self, *args, **kwargs):
+        super(Application, self).__init__(*args, **kwargs)
+        self.requests_in_flight = 0
+
+    def find_handler(self, request, **kwargs):
+        self.requests_in_flight += 1
+        return super(Application, self).find_handler(request, **kwargs)
+
+    def log_request(self, handler):
+        # called when a request is finished
+        self.requests_in_flight = max(self.requests_in_flight - 1, 0)
+        super(Application, self).log_request(handler)
+
 def get_app(APP_LIST):
-    return tornado.web.Application(APP_LIST, **settings)
+    return Application(APP_LIST, **settings)
+
+def get_backends(APP_LIST):
+    '''the query backends (esq) of the handlers of APP_LIST.'''
+    backends = []
+    for spec in APP_LIST:
+        handler = spec.handler_class if isinstance(spec, tornado.web.URLSpec) else spec[1]
+        backend = getattr(handler, 'esq', None)
+        if backend is not None and not any(backend is b for b in backends):
+            backends.append(backend)
+    return backends
+
+def fork_workers(num_processes, sockets):
+    '''fork num_processes worker processes, return the worker id
+       (0 to num_processes - 1) in each of them.  The master process never returns: it
+       restarts the workers that exit, and on SIGTERM, closes its sockets, forwards
+       SIGTERM to the workers and exits once they are all done.
+    '''
+    children = {}
+    stopping = []
+
+    def start_child(worker_id):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            return worker_id
+        children[pid] = (worker_id, time.time())
+
+    def on_sigterm(signum, frame):
+        stopping.append(signum)
+        for sock in sockets:
+            sock.close()
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, on_sigterm)
+    logging.info("Starting %d server processes" % num_processes)
+    for i in range(num_processes):
+        if start_child(i) is not None:
+            return i
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        if pid not in children:
+            continue
+        worker_id, started = children.pop(pid)
+        if stopping:
+            continue
+        if os.WIFSIGNALED(status):
+            reason = "was killed by signal %d" % os.WTERMSIG(status)
+        else:
+            reason = "exited with status %d" % os.WEXITSTATUS(status)
+        logging.warning("Server process %d (pid %d) %s, restarting" % (worker_id, pid, reason))
+        if time.time() - started < 1:
+            # don't restart a crashing worker in a tight loop
+            time.sleep(1)
+        if start_child(worker_id) is not None:
+            return worker_id
+    sys.exit(0)
+
+def shutdown(http_server, application, timeout):
+    '''stop accepting connections, then stop the IOLoop once the requests in flight are
+       finished, or after timeout seconds.
+    '''
+    http_server.stop()
+    deadline = time.time() + timeout
+    loop = tornado.ioloop.IOLoop.current()
+
+    def check():
+        if application.requests_in_flight and time.time() < deadline:
+            loop.call_later(0.1, check)
+        else:
+            loop.stop()
+    check()
 
 def main(APP_LIST):
+    # the sockets are bound before forking, the worker processes share them
+    sockets = tornado.netutil.bind_sockets(options.port, address=options.address, reuse_port=options.reuse_port)
+    num_processes = options.processes if options.processes > 0 else tornado.process.cpu_count()
+    if not options.debug and num_processes != 1:
+        fork_workers(num_processes, sockets)
+        for backend in get_backends(APP_LIST):
+            # connections opened by the master process (e.g. to load the index metadata) can't be shared
+            backend.reconnect()
+            # requests, e.g. the batches of a scroll, land on any worker
+            backend.set_workers(num_processes)
     application = get_app(APP_LIST)
-    http_server = tornado.httpserver.HTTPServer(application)
-    http_server.listen(options.port, address=options.address)
+    http_server = tornado.httpserver.HTTPServer(application, xheaders=options.xheaders)
+    http_server.add_sockets(sockets)
     loop = tornado.ioloop.IOLoop.instance()
+    signal.signal(signal.SIGTERM, lambda signum, frame: loop.add_callback_from_signal(
+                  shutdown, http_server, application, options.drain_timeout))
     if options.debug:
         tornado.autoreload.start(loop)
         tornado.autoreload.watch(os.path.join(btsettings.static_path, 'index.html'))